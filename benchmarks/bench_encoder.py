@@ -0,0 +1,70 @@
+"""
+Measures encode throughput of the upload encoding stage (src/encoder.py) on
+synthetic images sized like our Flux outputs.
+
+Usage: python benchmarks/bench_encoder.py [--megapixels 1 2 4] [--workers 1 2 4] [--count 16]
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from PIL import Image, ImageFilter  # noqa: E402
+
+import encoder  # noqa: E402
+
+
+def make_image(megapixels):
+    """
+    PNG with noise and soft structure, closer to a real render than a flat colour
+    """
+    side = int((megapixels * 1_000_000) ** 0.5)
+    noise = Image.effect_noise((side, side), 64).filter(ImageFilter.GaussianBlur(2))
+    img = Image.merge("RGB", (noise, noise.rotate(90), noise.rotate(180)))
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def run(source, format, quality, renditions, workers, count):
+    encoder.ENCODE_WORKERS = workers
+    encoder.pool = None
+    pool = encoder.get_pool()
+    # warm the worker processes up before timing
+    list(pool.map(encoder.encode_image, [source] * workers, [format] * workers))
+
+    started = time.perf_counter()
+    futures = [pool.submit(encoder.encode_image, source, format, quality, renditions) for _ in range(count)]
+    encoded = sum(len(data) for future in futures for _, data in future.result())
+    elapsed = time.perf_counter() - started
+
+    pool.shutdown()
+    encoder.pool = None
+    return count / elapsed, encoded / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, encoder.ENCODE_WORKERS])
+    parser.add_argument("--formats", nargs="+", default=["jpeg", "webp"])
+    parser.add_argument("--quality", type=int, default=encoder.DEFAULT_QUALITY)
+    parser.add_argument("--renditions", type=int, nargs="*", default=[])
+    parser.add_argument("--count", type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"{'MP':>4} {'format':>6} {'workers':>7} {'img/s':>8} {'img/s/core':>10} {'avg KB':>8}")
+    for megapixels in args.megapixels:
+        source = make_image(megapixels)
+        for format in args.formats:
+            for workers in sorted(set(args.workers)):
+                rate, size = run(source, format, args.quality, tuple(args.renditions), workers, args.count)
+                print(f"{megapixels:>4} {format:>6} {workers:>7} {rate:>8.2f} {rate / workers:>10.2f} {size / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
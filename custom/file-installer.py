@@ -1,7 +1,27 @@
 import os
 import json
+import hashlib
 import subprocess
 import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# files downloaded at the same time
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+# parallel range requests per large file
+DOWNLOAD_CHUNK_WORKERS = int(os.environ.get("DOWNLOAD_CHUNK_WORKERS", 8))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 64 * 1024 * 1024))
+DOWNLOAD_RETRIES = 5
+# repositories fetched at the same time
+GIT_WORKERS = int(os.environ.get("GIT_WORKERS", 8))
+# hash of the last merged custom node requirements that were installed
+REQUIREMENTS_MARKER = os.environ.get("REQUIREMENTS_MARKER", "/comfyui/custom_nodes/.requirements.sha256")
+DOWNLOAD_TIMEOUT = 60
+BUFFER_SIZE = 1024 * 1024
 
 
 # Helper function to print to both stdout and stderr for visibility
@@ -10,12 +30,330 @@ def log(message):
     # print(message, file=sys.stderr, flush=True)
 
 
+class RedirectHandler(urllib.request.HTTPRedirectHandler):
+    # huggingface redirects to a presigned CDN url that rejects a second auth mechanism
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_request = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new_request is not None and urllib.parse.urlsplit(newurl).netloc != urllib.parse.urlsplit(req.full_url).netloc:
+            new_request.remove_header("Authorization")
+        return new_request
+
+
+opener = urllib.request.build_opener(RedirectHandler)
+
+
+def request(url, method="GET", headers=None):
+    headers = dict(headers or {})
+    HF_TOKEN = os.environ.get("HF_TOKEN")
+    if HF_TOKEN:
+        headers["Authorization"] = f"Bearer {HF_TOKEN}"
+    return opener.open(urllib.request.Request(url, method=method, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+
+
+def retry(description, fn):
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            return fn()
+        except (urllib.error.URLError, OSError) as e:
+            if attempt + 1 == DOWNLOAD_RETRIES:
+                raise
+            delay = 2**attempt
+            log(f"  {description} failed ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+
+
+def probe(url):
+    """
+    Returns (size, supports ranges) of a remote file, size is None when unknown
+    """
+    # a one byte range request works on servers/CDNs that don't answer HEAD properly
+    with request(url, headers={"Range": "bytes=0-0"}) as response:
+        content_range = response.headers.get("Content-Range", "")
+        if response.status == 206 and "/" in content_range:
+            size = content_range.rsplit("/", 1)[1]
+            return (int(size) if size.isdigit() else None), True
+        length = response.headers.get("Content-Length")
+        return (int(length) if length else None), False
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verified_marker(path):
+    # remembers that a file was hashed, so rebuilds don't read 20GB again
+    return f"{path}.sha256"
+
+
+def is_valid(path, hash=None, size=None):
+    """
+    True if the file at path is complete: it matches hash when given, otherwise the remote size
+    """
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if size is not None and stat.st_size != size:
+        return False
+    if not hash:
+        return stat.st_size > 0
+    marker = verified_marker(path)
+    if os.path.exists(marker):
+        with open(marker, "r") as f:
+            if f.read().split() == [hash.lower(), str(stat.st_size), str(int(stat.st_mtime))]:
+                return True
+    if sha256_file(path) != hash.lower():
+        return False
+    with open(marker, "w") as f:
+        f.write(f"{hash.lower()} {stat.st_size} {int(stat.st_mtime)}")
+    return True
+
+
+class ChunkState:
+    """
+    Chunks of a .part file that are already written, persisted next to it for resuming
+    """
+
+    def __init__(self, path, url, size):
+        self.path = f"{path}.part.json"
+        self.lock = threading.Lock()
+        self.done = set()
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+            if state.get("url") == url and state.get("size") == size and state.get("chunk_size") == DOWNLOAD_CHUNK_SIZE:
+                self.done = set(state.get("done", []))
+        except (OSError, ValueError):
+            pass
+        self.url = url
+        self.size = size
+
+    def complete(self, index):
+        with self.lock:
+            self.done.add(index)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {"url": self.url, "size": self.size, "chunk_size": DOWNLOAD_CHUNK_SIZE, "done": sorted(self.done)},
+                    f,
+                )
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch_range(url, part_path, start, end):
+    """
+    Writes bytes start..end (inclusive) of url into part_path at the same offset
+    """
+
+    def attempt():
+        with request(url, headers={"Range": f"bytes={start}-{end}"}) as response:
+            if response.status != 206:
+                raise OSError(f"expected a partial response, got {response.status}")
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                written = 0
+                for block in iter(lambda: response.read(BUFFER_SIZE), b""):
+                    f.write(block)
+                    written += len(block)
+            if written != end - start + 1:
+                raise OSError(f"short read, {written} of {end - start + 1} bytes")
+
+    retry(f"range {start}-{end}", attempt)
+
+
+def download_chunked(url, part_path, size, state):
+    if not os.path.exists(part_path) or not state.done:
+        state.done = set()
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+
+    chunks = [
+        (index, start, min(start + DOWNLOAD_CHUNK_SIZE, size) - 1)
+        for index, start in enumerate(range(0, size, DOWNLOAD_CHUNK_SIZE))
+    ]
+    missing = [chunk for chunk in chunks if chunk[0] not in state.done]
+    if len(missing) < len(chunks):
+        log(f"  resuming, {len(chunks) - len(missing)}/{len(chunks)} chunks already downloaded")
+
+    def fetch(chunk):
+        index, start, end = chunk
+        fetch_range(url, part_path, start, end)
+        state.complete(index)
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CHUNK_WORKERS) as pool:
+        # list() so the first failed chunk raises here
+        list(pool.map(fetch, missing))
+
+
+def download_stream(url, part_path, resumable):
+    def attempt():
+        offset = os.path.getsize(part_path) if resumable and os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with request(url, headers=headers) as response:
+            if offset and response.status != 206:
+                offset = 0
+            with open(part_path, "ab" if offset else "wb") as f:
+                for block in iter(lambda: response.read(BUFFER_SIZE), b""):
+                    f.write(block)
+
+    retry(f"download of {url}", attempt)
+
+
+def download(url, path, hash=None):
+    """
+    Downloads url to path unless a valid copy is already there.
+    Large files are fetched as parallel ranges, interrupted downloads resume from the .part file.
+    """
+    size, ranges = retry(f"probe of {url}", lambda: probe(url))
+    if is_valid(path, hash, size):
+        log(f"✓ {path} already present, skipping")
+        return
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part_path = f"{path}.part"
+    log(f"Downloading {url} to {path} ({size if size is not None else 'unknown'} bytes)...")
+    started = time.monotonic()
+
+    if ranges and size:
+        state = ChunkState(path, url, size)
+        download_chunked(url, part_path, size, state)
+    else:
+        state = None
+        download_stream(url, part_path, ranges)
+
+    if size is not None and os.path.getsize(part_path) != size:
+        raise OSError(f"incomplete download, {os.path.getsize(part_path)} of {size} bytes")
+    if hash:
+        actual = sha256_file(part_path)
+        if actual != hash.lower():
+            # corrupt, start from scratch next time
+            os.remove(part_path)
+            if state is not None:
+                state.remove()
+            raise OSError(f"sha256 mismatch, expected {hash} got {actual}")
+
+    os.replace(part_path, path)
+    if state is not None:
+        state.remove()
+    if hash:
+        stat = os.stat(path)
+        with open(verified_marker(path), "w") as f:
+            f.write(f"{hash.lower()} {stat.st_size} {int(stat.st_mtime)}")
+    seconds = time.monotonic() - started
+    log(f"✓ Successfully downloaded {url} and saved it to {path} in {seconds:.1f}s")
+
+
+def git(args, cwd=None):
+    subprocess.check_call(["git"] + args, cwd=cwd, stdout=subprocess.DEVNULL)
+
+
+def git_head(path):
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path, stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def clone(url, path, hash=None):
+    """
+    Checks out a repository at its pinned commit, fetching only that commit
+    """
+    if hash and os.path.isdir(path) and git_head(path) == hash:
+        log(f"✓ {path} already at {hash[:12]}, skipping")
+        return
+
+    log(f"Cloning {url} to {path}...")
+    if not hash:
+        git(["clone", "--depth", "1", url, path])
+    else:
+        os.makedirs(path, exist_ok=True)
+        git(["init", "-q"], cwd=path)
+        subprocess.call(["git", "remote", "remove", "origin"], cwd=path, stderr=subprocess.DEVNULL)
+        git(["remote", "add", "origin", url], cwd=path)
+        try:
+            git(["fetch", "-q", "--depth", "1", "origin", hash], cwd=path)
+        except subprocess.CalledProcessError:
+            # servers that don't allow fetching a commit by hash
+            log(f"  shallow fetch of {hash[:12]} refused, fetching full history of {url}")
+            git(["fetch", "-q", "origin"], cwd=path)
+        git(["checkout", "-q", "--force", hash], cwd=path)
+    if os.path.exists(os.path.join(path, ".gitmodules")):
+        git(["submodule", "update", "-q", "--init", "--recursive", "--depth", "1"], cwd=path)
+    log(f"✓ Successfully cloned Git repository from {url} to {path}")
+
+
+def merge_requirements(paths):
+    """
+    Returns the lines of every repository's requirements.txt, deduplicated, in order
+    """
+    lines = []
+    for path in paths:
+        requirements_path = os.path.join(path, "requirements.txt")
+        if not os.path.exists(requirements_path):
+            continue
+        with open(requirements_path, "r") as f:
+            for line in f:
+                line = line.split(" #", 1)[0].strip()
+                if not line or line.startswith("#"):
+                    continue
+                # nested requirement/constraint files are relative to the repository
+                for option in ("-r ", "-c "):
+                    if line.startswith(option):
+                        line = option + os.path.join(path, line[len(option) :].strip())
+                if line not in lines:
+                    lines.append(line)
+    return lines
+
+
+def install_requirements(paths):
+    """
+    Installs the requirements of all custom nodes with a single pip resolve,
+    skipped when the same set was installed before
+    """
+    lines = merge_requirements(paths)
+    if not lines:
+        return
+    content = "\n".join(lines) + "\n"
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    if os.path.exists(REQUIREMENTS_MARKER):
+        with open(REQUIREMENTS_MARKER, "r") as f:
+            if f.read().strip() == digest:
+                log("✓ Custom node requirements unchanged, skipping pip install")
+                return
+
+    merged_path = os.path.join(os.path.dirname(REQUIREMENTS_MARKER) or ".", "requirements.merged.txt")
+    with open(merged_path, "w") as f:
+        f.write(content)
+    log(f"Installing {len(lines)} merged custom node requirement(s)...")
+    try:
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", merged_path])
+    except subprocess.CalledProcessError as e:
+        # nodes pinning conflicting versions can't be resolved together, install them one by one like before
+        log(f"  merged install failed ({e}), installing per node")
+        for path in paths:
+            requirements_path = os.path.join(path, "requirements.txt")
+            if os.path.exists(requirements_path):
+                subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", requirements_path])
+    with open(REQUIREMENTS_MARKER, "w") as f:
+        f.write(digest)
+    log("✓ Custom node requirements installed")
+
+
 # Load JSON data from the file (get json_file_path from arg)
 if len(sys.argv) < 2:
-    log("Usage: python3 custom-file-installer.py <json_file_path>")
+    log("Usage: python3 custom-file-installer.py <json_file_path> [--requirements]")
     sys.exit(1)
 
 json_file_path = sys.argv[1]
+# also pip install the requirements of the cloned repositories
+with_requirements = "--requirements" in sys.argv[2:]
 
 log(f"Loading custom files from {json_file_path}...")
 with open(json_file_path, "r") as json_file:
@@ -23,6 +361,8 @@ with open(json_file_path, "r") as json_file:
 
 log(f"Found {len(data)} custom file(s) to install.")
 
+repositories = []
+downloads = []
 # Iterate over each object in the JSON array
 for item in data:
     url = item.get("url")
@@ -31,27 +371,41 @@ for item in data:
 
     if url and path:
         if url.endswith(".git"):
-            try:  # Clone the Git repository into the specified path
-                log(f"Cloning {url} to {path}...")
-                subprocess.check_call(["git", "clone", url, path])
-                if hash:
-                    subprocess.check_call(["git", "checkout", hash], cwd=path)
-                log(f"✓ Successfully cloned Git repository from {url} to {path}")
-            except subprocess.CalledProcessError as e:
-                log(f"✗ Error cloning Git repository from {url}: {e}")
+            repositories.append((url, path, hash))
         else:
-            try:  # Download model into the specified path
-                log(f"Downloading {url} to {path}...")
-                HF_TOKEN = os.environ.get("HF_TOKEN")
-                wget_command = ["wget", "-O", path]
-                if HF_TOKEN:
-                    wget_command.extend(
-                        ["--header", f"Authorization: Bearer {HF_TOKEN}"]
-                    )
-                wget_command.extend([url])
-                subprocess.check_call(wget_command)
-                log(f"✓ Successfully downloaded {url} and saved it to {path}")
-            except subprocess.CalledProcessError as e:
-                log(f"✗ Error downloading {url}: {e}")
+            downloads.append((url, path, hash))
+
+failed = []
+
+
+def install_repository(url, path, hash):
+    try:
+        clone(url, path, hash)
+    except (subprocess.CalledProcessError, OSError) as e:
+        log(f"✗ Error cloning Git repository from {url}: {e}")
+        failed.append(url)
+
+
+def install(url, path, hash):
+    try:
+        download(url, path, hash)
+    except Exception as e:
+        log(f"✗ Error downloading {url}: {e}")
+        failed.append(url)
+
+
+with ThreadPoolExecutor(max_workers=GIT_WORKERS) as git_pool, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+    for url, path, hash in repositories:
+        git_pool.submit(install_repository, url, path, hash)
+    for url, path, hash in downloads:
+        pool.submit(install, url, path, hash)
+
+if failed:
+    # a missing or truncated model/node must not end up in the image
+    log(f"✗ {len(failed)} install(s) failed.")
+    sys.exit(1)
+
+if with_requirements:
+    install_requirements([path for _, path, _ in repositories])
 
 log("Download process completed.")
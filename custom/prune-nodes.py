@@ -0,0 +1,198 @@
+"""
+Writes a custom-nodes.json keeping only the node packs a set of workflows uses.
+
+Every class_type of the workflows is looked up in ComfyUI's /object_info, which
+names the python module (custom_nodes.<pack>) providing it. Run it against a
+ComfyUI with all packs of custom-nodes.json installed, then build the preset's
+image with the result (docker build --build-arg CUSTOM_NODES=...). The report
+lists the removed packs with the import time they cost in that ComfyUI's log,
+their size on disk and, with --measure-memory, the RAM their import takes.
+
+Usage: python3 custom/prune-nodes.py examples/flux2-input.json [...] --output custom/custom-nodes.flux2.json
+       [--object-info http://127.0.0.1:8188 | object_info.json] [--nodes custom/custom-nodes.json]
+       [--log /tmp/comfyui.log] [--keep ComfyUI-KJNodes] [--measure-memory]
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import urllib.request
+
+# packs that import another pack, the other one has to stay installed
+PACK_DEPENDENCIES = {
+    "ComfyUI-Impact-Subpack": ["ComfyUI-Impact-Pack"],
+}
+
+# "   0.3 seconds (IMPORT FAILED): /comfyui/custom_nodes/ComfyUI-Foo"
+IMPORT_TIME_PATTERN = re.compile(r"^\s*([\d.]+) seconds( \(IMPORT FAILED\))?: (.+?)\s*$")
+
+# imports a pack the way ComfyUI does after its own modules, prints the RSS growth in KiB
+MEASURE_SCRIPT = """
+import importlib.util, os, resource, sys
+sys.path.insert(0, sys.argv[1])
+os.chdir(sys.argv[1])
+import nodes
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+path = sys.argv[2]
+init = os.path.join(path, "__init__.py") if os.path.isdir(path) else path
+spec = importlib.util.spec_from_file_location(os.path.basename(path), init, submodule_search_locations=[path] if os.path.isdir(path) else None)
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+"""
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def pack_name(path):
+    name = os.path.basename(path.rstrip("/"))
+    return name[: -len(".py")] if name.endswith(".py") else name
+
+
+def load_workflow(path):
+    """
+    Returns the workflow of a file, either a job input ({"input": {"workflow": ...}}) or a bare workflow
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    return data.get("input", {}).get("workflow", data) if isinstance(data.get("input"), dict) else data
+
+
+def load_object_info(source):
+    if source.startswith("http://") or source.startswith("https://"):
+        with urllib.request.urlopen(f"{source.rstrip('/')}/object_info", timeout=60) as response:
+            return json.load(response)
+    with open(source, "r") as f:
+        return json.load(f)
+
+
+def read_import_times(path):
+    """
+    Returns pack name -> seconds its prestartup and import took in a ComfyUI log
+    """
+    seconds = {}
+    try:
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                match = IMPORT_TIME_PATTERN.match(line)
+                if match:
+                    name = pack_name(match.group(3))
+                    seconds[name] = seconds.get(name, 0) + float(match.group(1))
+    except FileNotFoundError:
+        pass
+    return seconds
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def measure_memory(comfy_path, path):
+    """
+    Returns the KiB of RAM importing a pack adds on top of ComfyUI's own modules, None if it fails to import
+    """
+    try:
+        output = subprocess.check_output(
+            [sys.executable, "-c", MEASURE_SCRIPT, comfy_path, path], stderr=subprocess.DEVNULL, timeout=600
+        )
+        return int(output.decode().strip().splitlines()[-1])
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError, IndexError):
+        return None
+
+
+def used_packs(workflows, object_info):
+    """
+    Returns the pack names the workflows use and the class types ComfyUI doesn't know
+
+    Args:
+    - workflows (list): Workflows in API format
+    - object_info (dict): ComfyUI's /object_info
+
+    Returns:
+    tuple: (dict of pack name -> sorted class types, sorted list of unknown class types)
+    """
+    packs = {}
+    unknown = set()
+    for workflow in workflows:
+        for node in workflow.values():
+            class_type = node.get("class_type")
+            info = object_info.get(class_type)
+            if info is None:
+                unknown.add(class_type)
+                continue
+            module = info.get("python_module", "nodes").split(".")
+            # core nodes are "nodes" or "comfy_extras.*"
+            if module[0] == "custom_nodes" and len(module) > 1:
+                packs.setdefault(pack_name(module[1]), set()).add(class_type)
+    return {name: sorted(class_types) for name, class_types in packs.items()}, sorted(unknown)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep only the custom node packs the given workflows use")
+    parser.add_argument("workflows", nargs="+", help="workflow or job input json files")
+    parser.add_argument("--output", required=True, help="custom-nodes.json to write")
+    parser.add_argument("--object-info", default="http://127.0.0.1:8188", help="ComfyUI url or saved /object_info json")
+    parser.add_argument("--nodes", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "custom-nodes.json"))
+    parser.add_argument("--log", default=os.environ.get("COMFY_LOG_PATH", "/tmp/comfyui.log"), help="ComfyUI log with the import times")
+    parser.add_argument("--keep", action="append", default=[], help="pack to keep even if unused")
+    parser.add_argument("--comfy-path", default="/comfyui")
+    parser.add_argument("--measure-memory", action="store_true", help="import every removed pack to measure its RAM")
+    args = parser.parse_args()
+
+    with open(args.nodes, "r") as f:
+        nodes = json.load(f)
+    workflows = [load_workflow(path) for path in args.workflows]
+    packs, unknown = used_packs(workflows, load_object_info(args.object_info))
+    if unknown:
+        # the pack providing them isn't installed or failed to import, pruning could drop it
+        log(f"✗ Unknown class types, is every pack of {args.nodes} installed? {', '.join(map(str, unknown))}")
+        sys.exit(1)
+
+    keep = set(packs) | set(args.keep)
+    for name in list(keep):
+        keep.update(PACK_DEPENDENCIES.get(name, []))
+
+    kept = [item for item in nodes if pack_name(item["path"]) in keep]
+    removed = [item for item in nodes if pack_name(item["path"]) not in keep]
+    with open(args.output, "w") as f:
+        json.dump(kept, f, indent=2)
+        f.write("\n")
+
+    import_times = read_import_times(args.log)
+    report = {"kept": [], "removed": []}
+    for item in kept:
+        name = pack_name(item["path"])
+        report["kept"].append({"name": name, "class_types": packs.get(name, [])})
+    for item in removed:
+        name = pack_name(item["path"])
+        entry = {"name": name, "import_seconds": import_times.get(name)}
+        if os.path.exists(item["path"]):
+            entry["disk_bytes"] = directory_size(item["path"])
+            if args.measure_memory:
+                entry["memory_kib"] = measure_memory(args.comfy_path, item["path"])
+        report["removed"].append(entry)
+
+    report["saved"] = {
+        "import_seconds": round(sum(entry["import_seconds"] or 0 for entry in report["removed"]), 3),
+        "disk_bytes": sum(entry.get("disk_bytes", 0) for entry in report["removed"]),
+    }
+    if args.measure_memory:
+        report["saved"]["memory_kib"] = sum(entry.get("memory_kib") or 0 for entry in report["removed"])
+    log(json.dumps(report, indent=2))
+    log(f"✓ Kept {len(kept)} of {len(nodes)} custom node pack(s), wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
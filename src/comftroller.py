@@ -14,9 +14,14 @@ import websockets
 import asyncio
 import base64
 import os
+import uuid
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-# local modules: 
-import utils 
+# local modules:
+import startup
+import utils
 
 ##################################################
 ###
@@ -29,18 +34,45 @@ comfy_port = int(os.environ.get('COMFY_PORT', 8188))
 # HOSTNAME and PORT where ComfyUI is running
 HOSTPORTNAME = f"127.0.0.1:{comfy_port}"
 
-# Time to wait between API check attempts in milliseconds
-API_AVAILABLE_INTERVAL_MS = 1000
+# Backoff bounds between API check attempts in milliseconds
+API_AVAILABLE_MIN_INTERVAL_MS = 50
+API_AVAILABLE_MAX_INTERVAL_MS = 500
 
-# Maximum number of API check attempts
-# should be available within 1 second!
-API_AVAILABLE_MAX_RETRIES = 99
+# Maximum time to wait for ComfyUI to come up, in seconds
+API_AVAILABLE_TIMEOUT_S = int(os.environ.get("COMFY_STARTUP_TIMEOUT", 120))
 
-# Time to wait between poll attempts in milliseconds
-HISTORY_POLLING_INTERVAL_MS = 100
+# Time to wait for the shared websocket to (re)connect before giving up on a job
+WS_CONNECT_TIMEOUT_MS = int(os.environ.get("COMFY_WS_CONNECT_TIMEOUT_MS", 10000))
 
-# Maximum number of poll attempts
-HISTORY_POLLING_MAX_RETRIES = 9
+# Backoff bounds between websocket reconnect attempts in milliseconds
+WS_RECONNECT_MIN_MS = 100
+WS_RECONNECT_MAX_MS = 5000
+
+# Maximum time a single job may take inside ComfyUI, in seconds
+JOB_TIMEOUT_S = int(os.environ.get("COMFY_JOB_TIMEOUT", 1800))
+
+# events for prompts nobody subscribed to (yet) are kept around for a
+# little while so a job that subscribes late does not miss them
+ORPHAN_PROMPTS_MAX = 64
+ORPHAN_EVENTS_MAX = 256
+
+# how finished images get to the worker:
+# "filesystem" - read back from the shared data directory ComfyUI writes to
+# "view"       - streamed into memory from ComfyUI's /view endpoint
+# "websocket"  - binary image frames pushed over the websocket (SaveImageWebsocket nodes)
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "filesystem")
+
+# ComfyUI's input directory (see start.sh), input files are stored there by content hash
+INPUT_PATH = os.environ.get("FS_PATH", "") + os.environ.get("DATA_PATH", "")
+
+# number of input files uploaded to ComfyUI at the same time
+INPUT_UPLOAD_WORKERS = int(os.environ.get("INPUT_UPLOAD_WORKERS", 4))
+
+# number of input hashes remembered as already present on ComfyUI
+KNOWN_INPUTS_MAX = 10000
+
+# the full /prompt body is only logged in development, it is the whole graph on every job
+LOG_PROMPTS = os.environ.get("ENV", "production") == "development"
 
 # base url for api and websocket
 API_URL = f"http://{HOSTPORTNAME}"
@@ -48,70 +80,99 @@ WS_URL = f"ws://{HOSTPORTNAME}/ws"
 
 # when set to true, allows for a LOT more events being sent to
 # the runpod worker for being polled. you might not want to
-# have so much information and only need general processing 
+# have so much information and only need general processing
 # information, in which case you can set this to False <3
-# Additionl events when True: 
+# Additionl events when True:
 # executing, executed, execution_start, execution_cached
 # NOTE: any "images" property referenced in these outputs is
 # unobtainable, as it only exists temporarily in the worker
 USE_CLIENT_ID = True
 
+# pooled http session for calls to the ComfyUI api
+session = requests.Session()
+
 ##################################################
 ###
 ### FUNCTIONS
 ###
 ##################################################
 
-# some random client id for current session, so we can 
-# get extra data on the nodes that are executing etc. 
-# DONT CHANGE THIS, ITS USED INTERNALLY BY WS :)
-SESSION_CLIENT_ID = None 
-
 
-def check_server(url=None, retries=99, delay=1000):
+def check_server(url=None, timeout=API_AVAILABLE_TIMEOUT_S, min_delay=API_AVAILABLE_MIN_INTERVAL_MS, max_delay=API_AVAILABLE_MAX_INTERVAL_MS):
     """
-    Check if a server is reachable via HTTP GET request
+    Check if a server is reachable via HTTP GET request, retrying with exponential backoff
 
     Args:
     - url (str): The URL to check
-    - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
-    - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+    - timeout (float, optional): Seconds to keep trying. Default is API_AVAILABLE_TIMEOUT_S
+    - min_delay (int, optional): First wait between attempts in milliseconds, doubled after every attempt
+    - max_delay (int, optional): Longest wait between attempts in milliseconds
 
     Returns:
-    bool: True if the server is reachable within the given number of retries, otherwise False
+    bool: True if the server is reachable within the timeout, otherwise False
     """
-    for i in range(retries):
+    deadline = time.monotonic() + timeout
+    delay = min_delay
+    attempts = 0
+    while True:
+        attempts += 1
         try:
-            response = requests.get(url)
+            response = requests.get(url, timeout=max(0.1, min(2, deadline - time.monotonic())))
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
-                utils.log(f"API: reachable!")
+                utils.log(f"API: reachable after {attempts} attempt(s)!")
                 return True
         except requests.RequestException as e:
-            # utils.log(f"API: unreachable.. retrying in {delay}ms")
             # If an exception occurs, the server may not be ready
             pass
 
-        # Wait for the specified delay before retrying
-        time.sleep(delay/1000)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining * 1000) / 1000)
+        delay = min(delay * 2, max_delay)
 
-    utils.log(f"Failed to connect to server at {url} after {retries} attempts.")
+    utils.log(f"Failed to connect to server at {url} after {attempts} attempts.")
     return False
 
 
-def queue_workflow(workflow):
+server_ready = threading.Event()
+server_check_lock = threading.Lock()
+
+
+def wait_for_server():
+    """
+    Waits for the ComfyUI API to come up. Checked once per process, afterwards
+    an unreachable ComfyUI shows up as websocket/queue errors instead.
+
+    Returns:
+    bool: True once ComfyUI answered
+    """
+    if server_ready.is_set():
+        return True
+    with server_check_lock:
+        if not server_ready.is_set() and check_server(API_URL):
+            startup.mark("comfyui_ready")
+            server_ready.set()
+    return server_ready.is_set()
+
+
+def queue_workflow(workflow, prompt_id=None, client_id=None):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
         workflow (dict): A dictionary containing the workflow to be processed
+        prompt_id (str, optional): The id ComfyUI should use for this prompt
+        client_id (str, optional): The websocket session that should receive the events
 
     Returns:
         dict: The JSON response from ComfyUI after processing the prompt
     """
 
     # "prompt": worlkflow
-    # "client_id": SESSION_CLIENT_ID
+    # "prompt_id": prompt_id
+    # "client_id": client_id
     # "number": 1
     # "front": True
     # "extra_data": {
@@ -119,15 +180,21 @@ def queue_workflow(workflow):
     # }
     opts = {"prompt": workflow}
 
-    if USE_CLIENT_ID: 
-        utils.log(f"queing workflow for session: {SESSION_CLIENT_ID}")
-        opts["client_id"] = SESSION_CLIENT_ID
+    if prompt_id:
+        opts["prompt_id"] = prompt_id
+
+    if USE_CLIENT_ID and client_id:
+        utils.log(f"queing workflow for session: {client_id}")
+        opts["client_id"] = client_id
 
-    else: 
+    else:
         utils.log(f"queing workflow")
 
     data = json.dumps(opts).encode("utf-8")
-    utils.log(f"queing data {data}")
+    if LOG_PROMPTS:
+        utils.log(f"queing data {data}")
+    else:
+        utils.log(f"queing {len(data)} bytes")
     req = urllib.request.Request(f"{API_URL}/prompt", data=data)
     return json.loads(urllib.request.urlopen(req).read())
 
@@ -146,7 +213,29 @@ def get_history(prompt_id):
         return json.loads(response.read())
 
 
+def view_image(filename, subfolder="", folder_type="output"):
+    """
+    Download an image ComfyUI produced into memory via the /view endpoint
+
+    Returns:
+        bytes: The image data
+    """
+    response = session.get(
+        f"{API_URL}/view",
+        params={"filename": filename, "subfolder": subfolder, "type": folder_type},
+        timeout=60,
+    )
+    response.raise_for_status()
+    return response.content
+
+
 def upload_image(filename, image_data, image_type="image/png", subfolder="", overwrite="true"):
+    """
+    Upload an image to ComfyUI's input directory
+
+    Returns:
+        dict: The JSON response from ComfyUI, raises on HTTP errors
+    """
     url = f"{API_URL}/upload/image"
     files = {'image': (filename, image_data, image_type)}
     data = {
@@ -154,150 +243,425 @@ def upload_image(filename, image_data, image_type="image/png", subfolder="", ove
         'overwrite': overwrite,
         'type': "input",
     }
+    response = session.post(url, files=files, data=data, timeout=60)
+    response.raise_for_status()  # Raise an exception for HTTP errors (e.g., 4xx, 5xx)
+    return response.json()
+
+
+def sniff_image_type(image_data):
+    """
+    Returns (extension, mime type) of encoded image bytes, defaults to png
+    """
+    if image_data[:3] == b"\xff\xd8\xff":
+        return "jpg", "image/jpeg"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return "png", "image/png"
+
+
+known_inputs = OrderedDict()
+inflight_inputs = {}
+inputs_lock = threading.Lock()
+input_pool = None
+
+
+def store_input(image_data):
+    """
+    Stores an input image on ComfyUI under its content hash, uploading it only
+    if it isn't there yet. Concurrent jobs storing the same image share one upload.
+
+    Returns:
+        str: The content addressed file name to reference in the workflow
+    """
+    extension, mime = sniff_image_type(image_data)
+    filename = f"input-{hashlib.sha256(image_data).hexdigest()[:32]}.{extension}"
+
+    with inputs_lock:
+        if filename in known_inputs:
+            known_inputs.move_to_end(filename)
+            return filename
+        pending = inflight_inputs.get(filename)
+        owner = pending is None
+        if owner:
+            pending = inflight_inputs[filename] = threading.Event()
+
+    if not owner:
+        pending.wait()
+        with inputs_lock:
+            if filename in known_inputs:
+                return filename
+        # the other upload failed, try ourselves
+        return store_input(image_data)
+
     try:
-        response = requests.post(url, files=files, data=data)
-        response.raise_for_status()  # Raise an exception for HTTP errors (e.g., 4xx, 5xx)
-        response_data = response.json()
-        print("Image uploaded successfully:", response_data)
-    except requests.exceptions.RequestException as e:
-        print("Error while uploading image:", e)
-
-
-async def comfy_websock_listener(ondata=utils.log):
-    global SESSION_CLIENT_ID
-    utils.log("WS: connecting...")
-    async with websockets.connect(WS_URL) as websocket:
-        utils.log("WS: connected!")
-        listening = True
-        
+        # the input dir is shared between workers, someone may have stored it already
+        if not (INPUT_PATH and os.path.exists(os.path.join(INPUT_PATH, filename))):
+            upload_image(filename, image_data, mime)
+        with inputs_lock:
+            known_inputs[filename] = True
+            while len(known_inputs) > KNOWN_INPUTS_MAX:
+                known_inputs.popitem(last=False)
+    finally:
+        with inputs_lock:
+            inflight_inputs.pop(filename, None)
+        pending.set()
+
+    return filename
+
+
+def ingest_files(files):
+    """
+    Decodes and stores base64 input files concurrently
+
+    Returns:
+        dict: Maps the legacy "upload-{index}.png" names to the stored file names
+    """
+    global input_pool
+    if not files:
+        return {}
+    with inputs_lock:
+        if input_pool is None:
+            input_pool = ThreadPoolExecutor(max_workers=INPUT_UPLOAD_WORKERS, thread_name_prefix="input")
+
+    futures = [input_pool.submit(lambda file=file: store_input(base64.b64decode(file))) for file in files]
+    return {f"upload-{id}.png": future.result() for id, future in enumerate(futures)}
+
+
+def rewrite_inputs(workflow, renames):
+    """
+    Returns the workflow with every node input equal to an old name pointing at the new one
+    """
+    if not renames:
+        return workflow
+    rewritten = {}
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        if any(isinstance(value, str) and value in renames for value in inputs.values()):
+            node = dict(node)
+            node["inputs"] = {
+                name: renames.get(value, value) if isinstance(value, str) else value
+                for name, value in inputs.items()
+            }
+        rewritten[node_id] = node
+    return rewritten
+
+
+class Subscription:
+    """
+    Receives the websocket events of a single queued prompt.
+    Events are delivered from the websocket thread, waiting happens on the job thread.
+    """
+
+    def __init__(self, prompt_id, ondata=utils.log):
+        self.prompt_id = prompt_id
+        self.ondata = ondata
+        self.error = None
+        # node id -> ui output, collected from the "executed" events as they arrive
+        self.outputs = {}
+        self.executing_node = None
+        self.images = 0
+        self.done = threading.Event()
+
+    def dispatch(self, event_dict):
+        event_type = event_dict.get("type")
+        event_data = event_dict.get("data", {})
+
+        # trigger utils.log or the handler's progress callback with the event.
+        # this is how we send event data out for polling via the status endpoints
         try:
-            while listening:
-                message = await websocket.recv()
-
-                ## the utils.log(message) below will output base64 data
-                # utils.log("WS: message!")
-                # utils.log(message)
-
-                if isinstance(message, bytes):
-                    # Handle binary data (similar to ArrayBuffer)
-                    data_view = memoryview(message)
-                    event_type = int.from_bytes(data_view[0:4], byteorder='big')
-                    buffer = data_view[4:]
-                    
-                    if event_type == 1:
-                        # Handle binary data with specific event type
-                        image_type = int.from_bytes(data_view[4:8], byteorder='big')
-                        image_data = buffer
-                    
-                        if image_type == 1:
-                            image_mime = "image/jpeg"
-                        elif image_type == 2:
-                            image_mime = "image/png"
-                        else:
-                            image_mime = "image/png"
-
-                        # Create a Blob-like object from bytes
-                        image_blob = bytes(buffer)
-
-                        # utils.log(f"preview received in {image_mime} format")
-                        # !todo?: Emit or process image_blob as needed
-
-                    else:
-                        # Handle other binary data as needed
-                        pass
-                else:
-                    # Handle non-binary (e.g., JSON) data
-
-                    # Add error handling for JSON decoding
-                    try:
-                        event_dict = json.loads(message)
-                    except json.JSONDecodeError as e:
-                        utils.log(f"JSON decoding error: {e}")
-                        pass # Skip this message and continue listening
-
-                    event_type = event_dict.get('type')
-                    event_data = event_dict.get('data', {})
-
-                    # trigger utils.log or runpod.serverless.process_update and send the event_dict. 
-                    # This is how we send event data out to runpod for polling via the worker/status endpoint
-                    if(event_type != 'crystools.monitor'):
-                        ondata(json.dumps(event_dict))
-
-                    if event_type == 'status':
-                        sid = event_data.get('sid')
-                        status = event_data.get('status', {})
-                        exec_info = status.get('exec_info', {})
-                        queue = exec_info.get('queue_remaining', {})
-                        # queue WILL be 0 when initially connecting, as we havent sent the 
-                        # workflow yet, which is triggered ms after we set the session id 
-                        if sid is None and queue == 0:
-                            utils.log("execution_complete")
-                            SESSION_CLIENT_ID = None
-                            listening = False
-                        # set the sessionid, to be used when triggering the workflow
-                        # things are done this way to give access to many more ws events
-                        elif sid is not None and SESSION_CLIENT_ID is None:
-                            SESSION_CLIENT_ID = event_data.get('sid')
-                            utils.log(f"obtained session id: {SESSION_CLIENT_ID}")
-                        
-                    elif event_type == 'error' or event_type == 'close':
-                        SESSION_CLIENT_ID = None
-                        listening = False
-
-        except websockets.exceptions.ConnectionClosedError as e:
-            utils.log(f"WebSocket connection closed: {e}")
+            self.ondata(json.dumps(event_dict))
         except Exception as e:
-            utils.log(f"An unexpected error occurred: {e}")
+            utils.log(f"WS: error handling event for {self.prompt_id}: {e}")
+
+        if event_type == "executing":
+            self.executing_node = event_data.get("node")
+            if self.executing_node is None:
+                # older ComfyUI versions don't send execution_success
+                self.done.set()
+        elif event_type == "executed":
+            self.add_output(event_data.get("node"), event_data.get("output"))
+        elif event_type == "execution_success":
+            utils.log(f"execution_complete: {self.prompt_id}")
+            self.done.set()
+        elif event_type in ("execution_error", "execution_interrupted"):
+            self.fail(event_data.get("exception_message") or event_type)
+
+    def add_output(self, node_id, output):
+        if node_id is None or not output:
+            return
+        node_output = self.outputs.setdefault(node_id, {})
+        for name, value in output.items():
+            # a node may execute several times (lists), so merge instead of replace
+            if isinstance(value, list) and isinstance(node_output.get(name), list):
+                node_output[name] = node_output[name] + value
+            else:
+                node_output[name] = value
+
+    def add_image(self, image_mime, image_data):
+        """
+        Keeps an image frame pushed over the websocket as output of the executing node
+        """
+        node_id = self.executing_node or "websocket"
+        extension = "jpg" if image_mime == "image/jpeg" else "png"
+        self.images += 1
+        image = {
+            "filename": f"{self.prompt_id}_{node_id}_{self.images:05}.{extension}",
+            "subfolder": "",
+            "type": "websocket",
+            "data": image_data,
+        }
+        self.add_output(node_id, {"images": [image]})
+
+    def fail(self, message):
+        self.error = message
+        self.done.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class ComfyConnection:
+    """
+    One long-lived websocket per worker, shared by every job.
+
+    Events are routed to the Subscription registered for their prompt_id, so
+    any number of jobs can be queued on ComfyUI at the same time. The socket
+    reconnects automatically; prompts that finished while it was down are
+    reconciled against /history.
+    """
 
+    def __init__(self, url=WS_URL):
+        # our own client id, so we don't have to wait for ComfyUI to hand us one
+        self.client_id = uuid.uuid4().hex
+        self.url = f"{url}?clientId={self.client_id}"
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.orphans = OrderedDict()
+        # binary frames (previews) don't carry a prompt id, ComfyUI runs one prompt at a time
+        self.executing_prompt_id = None
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=lambda: asyncio.run(self.listen_forever()),
+                    name="comfy-ws",
+                    daemon=True,
+                )
+                self.thread.start()
+
+    def wait_connected(self, timeout=None):
+        self.start()
+        return self.connected.wait(timeout)
+
+    def subscribe(self, prompt_id, ondata=utils.log):
+        subscription = Subscription(prompt_id, ondata)
+        with self.lock:
+            self.subscriptions[prompt_id] = subscription
+            missed = self.orphans.pop(prompt_id, [])
+        for event_dict in missed:
+            subscription.dispatch(event_dict)
+        return subscription
+
+    def resubscribe(self, subscription, prompt_id):
+        """
+        Moves a subscription to the prompt id ComfyUI actually assigned
+        """
+        with self.lock:
+            self.subscriptions.pop(subscription.prompt_id, None)
+            self.orphans.pop(subscription.prompt_id, None)
+        subscription.prompt_id = prompt_id
+        with self.lock:
+            self.subscriptions[prompt_id] = subscription
+            missed = self.orphans.pop(prompt_id, [])
+        for event_dict in missed:
+            subscription.dispatch(event_dict)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if self.subscriptions.get(subscription.prompt_id) is subscription:
+                del self.subscriptions[subscription.prompt_id]
+
+    async def listen_forever(self):
+        delay = WS_RECONNECT_MIN_MS
+        reconnecting = False
+        while True:
+            try:
+                utils.log("WS: connecting...")
+                async with websockets.connect(self.url, max_size=None) as websocket:
+                    utils.log(f"WS: connected! session: {self.client_id}")
+                    startup.mark("websocket_connected")
+                    self.connected.set()
+                    delay = WS_RECONNECT_MIN_MS
+                    if reconnecting:
+                        await asyncio.to_thread(self.reconcile)
+                    reconnecting = True
+
+                    async for message in websocket:
+                        self.handle_message(message)
+
+            except websockets.exceptions.ConnectionClosed as e:
+                utils.log(f"WebSocket connection closed: {e}")
+            except Exception as e:
+                utils.log(f"WS: connection error: {e}")
+
+            self.connected.clear()
+            await asyncio.sleep(delay / 1000)
+            delay = min(delay * 2, WS_RECONNECT_MAX_MS)
+
+    def reconcile(self):
+        """
+        Completes subscriptions whose prompt finished while the socket was down
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions.values())
+        for subscription in subscriptions:
+            try:
+                history = get_history(subscription.prompt_id)
+            except Exception as e:
+                utils.log(f"WS: unable to reconcile {subscription.prompt_id}: {e}")
+                continue
+            prompt_history = history.get(subscription.prompt_id, {})
+            status = prompt_history.get("status", {})
+            if status.get("completed"):
+                # the executed events were missed, take the outputs from history instead
+                for node_id, output in prompt_history.get("outputs", {}).items():
+                    subscription.outputs.setdefault(node_id, output)
+                subscription.done.set()
+            elif status.get("status_str") == "error":
+                subscription.fail("execution_error")
+
+    def handle_message(self, message):
+        ## the utils.log(message) below will output base64 data
+        # utils.log("WS: message!")
+        # utils.log(message)
+
+        if isinstance(message, bytes):
+            # Handle binary data (similar to ArrayBuffer)
+            data_view = memoryview(message)
+            event_type = int.from_bytes(data_view[0:4], byteorder='big')
+
+            if event_type == 1:
+                # Handle binary data with specific event type
+                image_type = int.from_bytes(data_view[4:8], byteorder='big')
+                image_data = data_view[8:]
+
+                if image_type == 1:
+                    image_mime = "image/jpeg"
+                elif image_type == 2:
+                    image_mime = "image/png"
+                else:
+                    image_mime = "image/png"
 
-def run_comfy_websock_listener(ondata=utils.log):
-    asyncio.run(comfy_websock_listener(ondata))
+                # utils.log(f"preview received in {image_mime} format for {self.executing_prompt_id}")
+                if OUTPUT_MODE == "websocket":
+                    with self.lock:
+                        subscription = self.subscriptions.get(self.executing_prompt_id)
+                    if subscription is not None:
+                        subscription.add_image(image_mime, bytes(image_data))
 
+            else:
+                # Handle other binary data as needed
+                pass
+            return
 
-def run(workflow, files=[], ondata=utils.log):
-    # Make sure that the ComfyUI API is available
-    check_server(API_URL, API_AVAILABLE_MAX_RETRIES, API_AVAILABLE_INTERVAL_MS)
+        # Handle non-binary (e.g., JSON) data
+        try:
+            event_dict = json.loads(message)
+        except json.JSONDecodeError as e:
+            utils.log(f"JSON decoding error: {e}")
+            return # Skip this message and continue listening
 
-    thread = threading.Thread(target=lambda: run_comfy_websock_listener(ondata))
-    thread.start()
+        event_type = event_dict.get('type')
+        event_data = event_dict.get('data') or {}
 
-    retries = 0
-    while SESSION_CLIENT_ID is None and retries < 10:
-        wait_ms = 10 # small wait for ws connect event to fire?
-        time.sleep(wait_ms / 1000)
-        retries += 1
+        if event_type == 'crystools.monitor' or event_type == 'status':
+            return
 
-    utils.log(f"session id after {retries} retries: {SESSION_CLIENT_ID}")
+        prompt_id = event_data.get('prompt_id')
+        if prompt_id is None:
+            return
 
-    for id, file in enumerate(files):
-        image_data = base64.b64decode(file)
-        upload_image(f"upload-{id}.png", image_data, "uploads")
+        if event_type == 'execution_start':
+            self.executing_prompt_id = prompt_id
+        elif event_type == 'executing' and event_data.get('node') is None:
+            self.executing_prompt_id = None
+
+        with self.lock:
+            subscription = self.subscriptions.get(prompt_id)
+            if subscription is None:
+                events = self.orphans.setdefault(prompt_id, [])
+                if len(events) < ORPHAN_EVENTS_MAX:
+                    events.append(event_dict)
+                while len(self.orphans) > ORPHAN_PROMPTS_MAX:
+                    self.orphans.popitem(last=False)
+
+        if subscription is not None:
+            subscription.dispatch(event_dict)
+
+
+connection = None
+connection_lock = threading.Lock()
+
+
+def get_connection():
+    """
+    Returns the worker wide ComfyConnection, starting it on first use
+    """
+    global connection
+    with connection_lock:
+        if connection is None:
+            connection = ComfyConnection()
+        connection.start()
+        return connection
+
+
+def run(workflow, files=[], ondata=utils.log):
+    # Make sure that the ComfyUI API is available
+    if not wait_for_server():
+        return utils.error(f"ComfyUI API at {API_URL} is not reachable")
+
+    comfy = get_connection()
+    if not comfy.wait_connected(WS_CONNECT_TIMEOUT_MS / 1000):
+        return utils.error(f"Unable to connect to ComfyUI websocket at {WS_URL}")
 
     try:
-        queued = queue_workflow(workflow)
-        comfy_job_id = queued["prompt_id"]
-        utils.log(f"JOB: {comfy_job_id} queued!")
+        workflow = rewrite_inputs(workflow, ingest_files(files))
     except Exception as e:
-        return utils.error(f"Error queuing workflow: {str(e)}")
-    
-    thread.join() # Wait for the thread to finish
+        return utils.error(f"Error uploading input files: {str(e)}")
 
-    retries = 0
+    # subscribe before queueing so no event of this prompt can be missed
+    subscription = comfy.subscribe(str(uuid.uuid4()), ondata)
     try:
-        while retries < HISTORY_POLLING_MAX_RETRIES:
-            history = get_history(comfy_job_id)
+        try:
+            queued = queue_workflow(workflow, subscription.prompt_id, comfy.client_id)
+            comfy_job_id = queued["prompt_id"]
+            if comfy_job_id != subscription.prompt_id:
+                comfy.resubscribe(subscription, comfy_job_id)
+            utils.log(f"JOB: {comfy_job_id} queued!")
+        except Exception as e:
+            return utils.error(f"Error queuing workflow: {str(e)}")
 
-            # Exit the loop if we have found the history
-            if comfy_job_id in history and history[comfy_job_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(HISTORY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return utils.error(f"Max retries reached while waiting for image generation")
-    except Exception as e:
-        return utils.error(f"Error waiting for image generation: {str(e)}")    
+        if not subscription.wait(JOB_TIMEOUT_S):
+            return utils.error(f"Timed out after {JOB_TIMEOUT_S}s waiting for job {comfy_job_id}")
+        if subscription.error:
+            return utils.error(f"Error executing workflow: {subscription.error}")
+    finally:
+        comfy.unsubscribe(subscription)
+
+    if subscription.outputs:
+        return subscription.outputs
 
-    return history[comfy_job_id].get("outputs")
+    # nothing came in over the websocket, confirm once with the history
+    try:
+        history = get_history(comfy_job_id)
+    except Exception as e:
+        return utils.error(f"Error fetching history for job {comfy_job_id}: {str(e)}")
 
+    outputs = history.get(comfy_job_id, {}).get("outputs")
+    if not outputs:
+        return utils.error(f"Job {comfy_job_id} finished without outputs")
+    return outputs
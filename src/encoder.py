@@ -0,0 +1,141 @@
+"""
+CPU image encoding stage for uploads.
+
+Decoding and re-encoding outputs happens in a pool of worker processes so large
+upscaled images don't hold the GIL of the request threads. One pass produces the
+main image in the requested format plus any downscaled renditions.
+"""
+
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import utils
+
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 300000000))
+
+DEFAULT_QUALITY = 95
+
+# format -> (PIL format, extension, content type)
+FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "png": ("PNG", "png", "image/png"),
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+# extensions PIL can decode for us, anything else is uploaded untouched
+ENCODABLE_EXTENSIONS = ("png", "jpg", "jpeg", "webp")
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def normalize_format(format):
+    if format is None:
+        return None
+    format = FORMAT_ALIASES.get(format.lower(), format.lower())
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported output format '{format}', expected one of {list(FORMATS)}")
+    return format
+
+
+def extension(format):
+    return FORMATS[format][1]
+
+
+def content_type(format):
+    return FORMATS[format][2]
+
+
+def flatten(img, format):
+    """
+    Drops transparency for formats that can't store it (white background)
+    """
+    from PIL import Image
+
+    if format != "jpeg":
+        return img
+    if img.mode in ("RGBA", "LA", "P"):
+        # Create a white background
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        background.paste(
+            img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None
+        )
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def save(img, format, quality):
+    buffer = io.BytesIO()
+    pil_format = FORMATS[format][0]
+    if format == "png":
+        img.save(buffer, pil_format, compress_level=1)
+    else:
+        img.save(buffer, pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+def encode_image(source, format="jpeg", quality=DEFAULT_QUALITY, renditions=(), include_main=True):
+    """
+    Encodes an image and its downscaled renditions. Runs inside a pool process.
+
+    Args:
+    - source (str|bytes): Path of the image or its encoded bytes
+    - format (str): One of FORMATS
+    - quality (int): Encoder quality for lossy formats
+    - renditions (list): Maximum edge sizes in pixels of extra downscaled copies
+    - include_main (bool): False when the source is uploaded as is and only renditions are needed
+
+    Returns:
+    list: (rendition size or None for the main image, encoded bytes) tuples
+    """
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    img.load()
+    img = flatten(img, format)
+
+    results = [(None, save(img, format, quality))] if include_main else []
+    for size in renditions:
+        rendition = img.copy()
+        rendition.thumbnail((size, size), Image.LANCZOS)
+        results.append((size, save(rendition, format, quality)))
+    return results
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            # forkserver: don't fork the worker's websocket/upload threads into the children
+            context = multiprocessing.get_context("forkserver")
+            # the server preloads __main__ by default, only the encoder is needed
+            context.set_forkserver_preload(["encoder"])
+            pool = ProcessPoolExecutor(max_workers=ENCODE_WORKERS, mp_context=context)
+        return pool
+
+
+def encode(source, format="jpeg", quality=DEFAULT_QUALITY, renditions=(), include_main=True):
+    """
+    Encodes an image on the process pool and waits for the result,
+    see encode_image. Falls back to encoding in-process if the pool broke.
+    """
+    global pool
+    args = (source, format, quality, tuple(renditions), include_main)
+    try:
+        return get_pool().submit(encode_image, *args).result()
+    except BrokenProcessPool as e:
+        utils.log(f"Encoder pool broke, encoding in-process: {e}")
+        pool = None
+        return encode_image(*args)
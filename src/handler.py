@@ -3,37 +3,71 @@ The main serverless worker module for runpod
 """
 
 import os
-import requests
-import json
+import base64
 
 # src imports
 import comftroller
+import image_cache
 import utils
+import metrics
+import model_cache
+import result_cache
+import startup
+import status_store
+import templates
+import webhooks
+import workflow_schema
 
 # additional outputs logging. helpful for testing
 env = os.environ.get("ENV", "production")
 cloud_type = os.environ.get("CLOUD_TYPE")
 data_path = os.environ.get("FS_PATH") + os.environ.get("DATA_PATH")
+# local output directory of ComfyUI when outputs are collected over the wire
+output_path = os.environ.get("OUTPUT_PATH", "/comfyui/output")
 
 LOG_JOB_OUTPUTS = env == "development"
 
 utils.log(f"ENV: {env}")
 utils.log(f"CLOUD_TYPE: {cloud_type}")
 
-callback_data = {}
+callback_data = status_store.create_store()
 utils.setup_storage_credentials()
 
 
 def get_status(run_id):
-    return callback_data[run_id]
+    return callback_data.get(run_id)
 
 
-def process_callback(tracker, data):
+def process_callback(tracker, data, timeline=None):
     data = utils.safe_parse(data)
     tracker.update_progress(data)
+    if timeline is not None:
+        timeline.update(data)
     return {"progress": tracker.progress}
 
 
+def collect_output(data):
+    """
+    Returns the output file entry for an image/gif ComfyUI reported, either as a
+    path on the data directory or, for the wire output modes, its bytes in memory
+    """
+    if data.get("type") == "websocket":
+        return {"name": data["filename"], "data": data["data"]}
+
+    if comftroller.OUTPUT_MODE == "filesystem":
+        return {
+            "name": data["filename"],
+            "path": os.path.join(data_path, data["filename"]),
+        }
+
+    image_data = comftroller.view_image(data["filename"], data.get("subfolder", ""), data["type"])
+    # ComfyUI keeps its own copy on local disk, we hold the bytes now
+    local_path = os.path.join(output_path, data.get("subfolder", ""), data["filename"])
+    if os.path.exists(local_path):
+        os.remove(local_path)
+    return {"name": data["filename"], "data": image_data}
+
+
 def handler(job):
     """
     The main function that handles a job of generating an image.
@@ -49,13 +83,13 @@ def handler(job):
     """
     run_id = job["id"]
     job_input = job["input"]
-    workflow = job_input["workflow"]
+    workflow = job_input.get("workflow")
     metadata = job_input.get("metadata")
     callback_url = job_input.get("callback_url")
     callback_auth_header = job_input.get("callback_auth_header")
 
     def callback(data):
-        prev_data = callback_data.get(data["run_id"])
+        prev_data = callback_data.get(data["run_id"], {})
         prev_progress = prev_data.get("data", {}).get("progress", 0)
         new_progress = data.get("data", {}).get("progress", 0)
         status = data.get("status")
@@ -80,14 +114,8 @@ def handler(job):
         headers = {"Content-Type": "application/json"}
         if callback_auth_header:
             headers.update(callback_auth_header)
-        try:
-            requests.post(
-                callback_url,
-                headers=headers,
-                data=json.dumps(data),
-            )
-        except Exception as e:
-            pass
+        # delivered in the background so the websocket listener is never blocked
+        webhooks.send(callback_url, headers, data)
         return data
 
     # input workflow
@@ -97,6 +125,22 @@ def handler(job):
         "data": {"progress": 0},
     }
 
+    # jobs naming a template send parameters instead of the graph
+    if job_input.get("template_id") is not None:
+        try:
+            workflow = templates.resolve(job_input)
+        except templates.TemplateError as e:
+            error = f"Invalid template: {e}"
+            callback(
+                {
+                    "run_id": run_id,
+                    "status": "failed",
+                    "data": {"error": error},
+                    "metadata": metadata,
+                },
+            )
+            return utils.error(error)
+
     # Validate inputs
     if workflow is None:
         return utils.error(f"no 'input' property found on job data")
@@ -109,99 +153,185 @@ def handler(job):
             f"'workflow' must be a valid JSON object or JSON-encoded string"
         )
 
+    # reject broken workflows before any input is uploaded or ComfyUI is asked
+    errors = workflow_schema.validate(workflow)
+    if errors:
+        error = f"Invalid workflow: {'; '.join(errors)}"
+        callback(
+            {
+                "run_id": run_id,
+                "status": "failed",
+                "data": {"error": error, "validation_errors": errors},
+                "metadata": metadata,
+            },
+        )
+        return utils.error(error)
+
     # set callback for when comftroller processes incomming data
 
+    # models missing from the local disk tier get copied for the next job
+    model_cache.use(workflow)
+
     tracker = utils.ProgressTracker(workflow)
+    timeline = metrics.NodeTimeline(workflow)
 
     update_progress = lambda data: callback(
         {
             "run_id": run_id,
             "status": "processing",
-            "data": process_callback(tracker, data),
+            "data": process_callback(tracker, data, timeline),
             "metadata": metadata,
         }
     )
 
     input_files = job_input.get("files", [])
 
-    # outputs is equal to the completed comfyui job id history object
-    outputs = comftroller.run(workflow, input_files, update_progress)
-    # if LOG_JOB_OUTPUTS:
-    #     utils.log("---- RAW OUTPUTS ----")
-    #     utils.log(outputs)
-    #     utils.log("")
+    # fetch remote images to local disk now, so ComfyUI doesn't do it on GPU time
+    workflow, prefetched = image_cache.prefetch(workflow)
 
-    # if 'run' had an error, then stop job and return error as result
-    if outputs.get("error"):
+    # jobs that are identical to a finished or running one reuse its outputs
+    use_cache = job_input.get("cache") is None or utils.job_prop_to_bool(job_input, "cache")
+    try:
+        cache_key = result_cache.job_key(workflow, input_files, job_input.get("upload")) if use_cache else None
+    except Exception as e:
+        image_cache.release(prefetched)
+        error = f"Invalid input files: {e}"
         callback(
             {
                 "run_id": run_id,
                 "status": "failed",
-                "data": {"error": outputs.get("error")},
+                "data": {"error": error},
                 "metadata": metadata,
             },
         )
-        return {"error": outputs.get("error")}
-
-    # Fetching generated images
-    output_files = []  # array of output filepath/urls
-    # uglry nesterd lewpz: el boo!
-    for node_id, node_output in outputs.items():
-        # add output data to output_datas if not images or gifs data
-        # scan job outputs for images/gifs (videos)
-        if "images" in node_output:
-            for data in node_output["images"]:
-                if data.get("type") == "output":
-                    output_files.append(
-                        {
-                            "name": data["filename"],
-                            "path": os.path.join(data_path, data["filename"]),
-                        }
-                    )
-
-        if "gifs" in node_output:
-            for data in node_output["gifs"]:
-                if data.get("type") == "output":
-                    output_files.append(
-                        {
-                            "name": data["filename"],
-                            "path": os.path.join(data_path, data["filename"]),
-                        }
-                    )
-
-    # if you dont know what this does... you shouldnt be here.
-    if LOG_JOB_OUTPUTS:
-        utils.log(f"#files generated: {len(output_files)}")
-        utils.log("---- OUTPUT FILES ----")
-        utils.log(output_files)
-        utils.log("")
+        return utils.error(error)
+    if cache_key is not None:
+        # a job stuck past the ComfyUI timeout doesn't hold back the identical ones
+        cached = result_cache.acquire(cache_key, comftroller.JOB_TIMEOUT_S)
+        if cached is not None:
+            image_cache.release(prefetched)
+            utils.log(f"Reusing outputs of an identical job for {run_id}")
+            callback(
+                {
+                    "run_id": run_id,
+                    "status": "completed",
+                    "data": {"progress": 100, "output": cached, "cached": True},
+                    "metadata": metadata,
+                },
+            )
+            return cached
 
-    try:
-        if "upload" in job_input:
-            output_files = utils.upload_files(
-                output_files,
-                job_input["upload"].get("bucket"),
-                job_input["upload"].get("key"),
-                job_input["upload"].get("cloud_type"),
-                job_input["upload"].get("credentials"),
+    def run_workflow():
+        # outputs is equal to the completed comfyui job id history object
+        try:
+            outputs = comftroller.run(workflow, input_files, update_progress)
+        finally:
+            image_cache.release(prefetched)
+        # if LOG_JOB_OUTPUTS:
+        #     utils.log("---- RAW OUTPUTS ----")
+        #     utils.log(outputs)
+        #     utils.log("")
+
+        timeline.observe("failed" if outputs.get("error") else "completed")
+        startup.mark("first_job_done")
+
+        # if 'run' had an error, then stop job and return error as result
+        if outputs.get("error"):
+            callback(
+                {
+                    "run_id": run_id,
+                    "status": "failed",
+                    "data": {"error": outputs.get("error"), "timings": timeline.summary()},
+                    "metadata": metadata,
+                },
             )
-    except Exception as e:
-        utils.log(f"Error uploading files to GCP: {e}")
+            return {"error": outputs.get("error")}
+
+        # Fetching generated images
+        output_files = []  # array of output filepath/urls
+        # uglry nesterd lewpz: el boo!
+        try:
+            for node_id, node_output in outputs.items():
+                # add output data to output_datas if not images or gifs data
+                # scan job outputs for images/gifs (videos)
+                for data in node_output.get("images", []) + node_output.get("gifs", []):
+                    if data.get("type") in ("output", "websocket"):
+                        output_files.append(collect_output(data))
+        except Exception as e:
+            error = f"Error collecting outputs: {e}"
+            utils.log(error)
+            callback(
+                {
+                    "run_id": run_id,
+                    "status": "failed",
+                    "data": {"error": error},
+                    "metadata": metadata,
+                },
+            )
+            return {"error": error}
+
+        # if you dont know what this does... you shouldnt be here.
+        if LOG_JOB_OUTPUTS:
+            utils.log(f"#files generated: {len(output_files)}")
+            utils.log("---- OUTPUT FILES ----")
+            utils.log([{k: v for k, v in file.items() if k != "data"} for file in output_files])
+            utils.log("")
+
+        try:
+            if "upload" in job_input:
+                output_files = utils.upload_files(
+                    output_files,
+                    job_input["upload"].get("bucket"),
+                    job_input["upload"].get("key"),
+                    job_input["upload"].get("cloud_type"),
+                    job_input["upload"].get("credentials"),
+                    job_input["upload"],
+                )
+            else:
+                # images received over the wire have no path, hand them back inline
+                output_files = [
+                    {"name": file["name"], "base64": base64.b64encode(file["data"]).decode("utf-8")}
+                    if "data" in file
+                    else file
+                    for file in output_files
+                ]
+        except Exception as e:
+            utils.log(f"Error uploading files: {e}")
+            error = f"Error uploading files: {e}"
+            data = {"error": error}
+            if isinstance(e, utils.UploadError):
+                # per-file results, so the caller can see which outputs did make it
+                data["output"] = e.files
+            callback(
+                {
+                    "run_id": run_id,
+                    "status": "failed",
+                    "data": data,
+                    "metadata": metadata,
+                },
+            )
+            return {"error": error}
         callback(
             {
                 "run_id": run_id,
-                "status": "failed",
-                "data": {"error": "Error uploading files to GCP"},
+                "status": "completed",
+                "data": {"progress": 100, "output": output_files, "timings": timeline.summary()},
                 "metadata": metadata,
             },
         )
-        return {"error": "Error uploading files to GCP"}
-    callback(
-        {
-            "run_id": run_id,
-            "status": "completed",
-            "data": {"progress": 100, "output": output_files},
-            "metadata": metadata,
-        },
-    )
-    return output_files
\ No newline at end of file
+        return output_files
+
+    if cache_key is None:
+        return run_workflow()
+
+    output_files = None
+    try:
+        output_files = run_workflow()
+        return output_files
+    finally:
+        # errors are returned as a dict and never reused
+        result_cache.release(
+            cache_key,
+            output_files if isinstance(output_files, list) else None,
+            store="upload" in job_input,
+        )
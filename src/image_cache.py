@@ -0,0 +1,283 @@
+"""
+Local disk cache for the remote images of LoadImageFromUrlOrPath nodes.
+
+Before a workflow is queued, every url it loads is fetched concurrently into a
+size bounded, content addressed LRU on local disk (revalidated with
+ETag/Last-Modified) and the node inputs are rewritten to the local files. The
+downloads overlap with the queue wait instead of happening on the GPU's time.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils
+
+IMAGE_CACHE_PATH = os.environ.get("IMAGE_CACHE_PATH", "/comfyui/image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 2 * 1024**3))
+IMAGE_PREFETCH_WORKERS = int(os.environ.get("IMAGE_PREFETCH_WORKERS", 8))
+
+# seconds a cached url is served without asking the origin again
+IMAGE_CACHE_FRESH_SECONDS = int(os.environ.get("IMAGE_CACHE_FRESH_SECONDS", 60))
+
+IMAGE_FETCH_TIMEOUT = 30
+
+# node class -> input holding the url
+URL_INPUTS = {
+    "LoadImageFromUrlOrPath": "url_or_path",
+}
+
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+
+class Entry:
+    def __init__(self, path, size, etag=None, last_modified=None):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated = time.monotonic()
+        self.pins = 0
+
+
+class ImageCache:
+    """
+    Content addressed LRU of downloaded images.
+
+    Args:
+    - path (str): Directory the images are stored in
+    - max_bytes (int): Total size above which least recently used images are removed
+    - workers (int): Number of concurrent downloads
+    """
+
+    def __init__(self, path=IMAGE_CACHE_PATH, max_bytes=IMAGE_CACHE_MAX_BYTES, workers=IMAGE_PREFETCH_WORKERS):
+        self.path = path
+        self.max_bytes = max_bytes
+        # url -> Entry, in least recently used order
+        self.entries = OrderedDict()
+        # entries replaced by newer content while jobs still use their files
+        self.retired = set()
+        self.size = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+        # the index only lives in memory, anything left from a previous run is stale
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+    def prefetch(self, workflow):
+        """
+        Downloads every remote image of the workflow and points the nodes at the local copies
+
+        Returns:
+        tuple: (rewritten workflow, list of pinned entries to hand to release once the job ran)
+        """
+        targets = []
+        for node_id, node in workflow.items():
+            input_name = URL_INPUTS.get(node.get("class_type"))
+            url = node.get("inputs", {}).get(input_name) if input_name else None
+            if isinstance(url, str) and url.startswith(("http://", "https://")):
+                targets.append((node_id, input_name, url))
+        if not targets:
+            return workflow, []
+
+        urls = list(dict.fromkeys(url for _, _, url in targets))
+        futures = {url: self.pool.submit(self.fetch, url) for url in urls}
+
+        pinned = {}
+        for url, future in futures.items():
+            try:
+                pinned[url] = future.result()
+            except Exception as e:
+                # leave the url alone, the node will download it itself
+                utils.log(f"Prefetch of {url} failed: {e}")
+
+        workflow = dict(workflow)
+        for node_id, input_name, url in targets:
+            if url in pinned:
+                node = dict(workflow[node_id])
+                node["inputs"] = {**node["inputs"], input_name: pinned[url].path}
+                workflow[node_id] = node
+        return workflow, list(pinned.values())
+
+    def release(self, entries):
+        """
+        Unpins the entries of a finished job so their images may be evicted again.
+        Files of retired entries are removed with their last pin.
+        """
+        with self.lock:
+            for entry in entries:
+                if entry.pins > 0:
+                    entry.pins -= 1
+                if entry in self.retired and entry.pins == 0:
+                    self.retired.discard(entry)
+                    self.size -= entry.size
+                    self.remove_file(entry.path)
+            self.evict()
+
+    def fetch(self, url):
+        """
+        Returns the entry of url, downloading or revalidating it when needed.
+        The entry is pinned until release is called.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and time.monotonic() - entry.validated < IMAGE_CACHE_FRESH_SECONDS:
+                self.entries.move_to_end(url)
+                entry.pins += 1
+                return entry
+            pending = self.inflight.get(url)
+            owner = pending is None
+            if owner:
+                pending = self.inflight[url] = threading.Event()
+
+        if not owner:
+            # someone else is downloading this url right now
+            pending.wait()
+            return self.fetch(url)
+
+        try:
+            return self.download(url, entry)
+        finally:
+            with self.lock:
+                self.inflight.pop(url, None)
+            pending.set()
+
+    def download(self, url, cached=None):
+        """
+        Fetches url into the cache, conditionally when a cached entry exists.
+        Returns the entry, pinned once for the caller.
+        """
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        with self.session.get(url, headers=headers, stream=True, timeout=IMAGE_FETCH_TIMEOUT) as response:
+            if response.status_code == 304 and cached is not None:
+                with self.lock:
+                    current = self.entries.get(url)
+                    if current is None and os.path.exists(cached.path):
+                        # evicted while revalidating, the file is still there
+                        current = self.entries[url] = cached
+                        self.size += cached.size
+                    if current is cached:
+                        cached.validated = time.monotonic()
+                        cached.pins += 1
+                        self.entries.move_to_end(url)
+                        self.evict()
+                        return cached
+                # the entry changed or its file is gone, fetch it again unconditionally
+                return self.download(url)
+            response.raise_for_status()
+
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+            extension = EXTENSIONS.get(content_type) or url.split("?")[0].rsplit(".", 1)[-1].lower()
+            if extension not in EXTENSIONS.values() and extension != "jpeg":
+                extension = "png"
+
+            digest = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                path = os.path.join(self.path, f"{digest.hexdigest()}.{extension}")
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            entry = Entry(path, size, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+        with self.lock:
+            previous = self.entries.pop(url, None)
+            self.entries[url] = entry
+            self.size += entry.size
+            entry.pins = 1
+            if previous is not None:
+                if previous.pins > 0:
+                    # queued/running jobs point at its file, release removes it
+                    self.retired.add(previous)
+                else:
+                    self.size -= previous.size
+                    self.remove_file(previous.path)
+            self.evict()
+        return entry
+
+    def remove_file(self, path):
+        """
+        Deletes a cached file unless another url (or a retired entry) still points at the same content
+        """
+        if any(entry.path == path for entry in self.entries.values()) or any(
+            entry.path == path for entry in self.retired
+        ):
+            return
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self):
+        for url in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            entry = self.entries[url]
+            if entry.pins > 0:
+                continue
+            del self.entries[url]
+            self.size -= entry.size
+            self.remove_file(entry.path)
+
+
+cache = None
+cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the worker wide ImageCache, or None when caching is disabled or unavailable
+    """
+    global cache
+    with cache_lock:
+        if cache is None and IMAGE_CACHE_MAX_BYTES > 0:
+            try:
+                cache = ImageCache()
+            except OSError as e:
+                utils.log(f"Image cache disabled, unable to use {IMAGE_CACHE_PATH}: {e}")
+                cache = False
+        return cache or None
+
+
+def prefetch(workflow):
+    image_cache = get_cache()
+    if image_cache is None:
+        return workflow, []
+    return image_cache.prefetch(workflow)
+
+
+def release(entries):
+    if entries and cache:
+        cache.release(entries)
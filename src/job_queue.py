@@ -0,0 +1,192 @@
+"""
+Bounded admission queue for the GCP/AWS http server.
+Jobs are accepted up to a maximum depth and executed by a fixed number of workers.
+Waiting jobs using the models ComfyUI has loaded are started first, so mixed
+presets don't reload multi-GB weights on every job.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+
+import metrics
+import utils
+
+# weight of the latest job duration in the moving average used for Retry-After
+DURATION_SMOOTHING = 0.2
+
+# loader node class -> inputs naming the model files it loads
+MODEL_INPUTS = {
+    "UNETLoader": ("unet_name",),
+    "UnetLoaderGGUF": ("unet_name",),
+    "CheckpointLoaderSimple": ("ckpt_name",),
+    "CLIPLoader": ("clip_name",),
+    "CLIPLoaderGGUF": ("clip_name",),
+    "DualCLIPLoader": ("clip_name1", "clip_name2"),
+    "DualCLIPLoaderGGUF": ("clip_name1", "clip_name2"),
+    "VAELoader": ("vae_name",),
+    "LoraLoader": ("lora_name",),
+    "LoraLoaderModelOnly": ("lora_name",),
+    "UpscaleModelLoader": ("model_name",),
+}
+
+QUEUE_REORDERS = metrics.Counter(
+    "comfy_queue_reorders_total", "Jobs started ahead of older ones because their models were loaded"
+)
+MODEL_LOADS = metrics.Counter(
+    "comfy_model_loads_total", "Model files jobs needed that the previous job didn't use"
+)
+REORDER_LOADS_SAVED = metrics.Counter(
+    "comfy_queue_reorder_loads_saved_total",
+    "Model loads fewer than the oldest job would have needed, counted only when a younger job was started instead",
+)
+
+
+def workflow_models(workflow):
+    """
+    Returns the model file names the loader nodes of a workflow reference
+    """
+    workflow = utils.validate_json(workflow) if isinstance(workflow, str) else workflow
+    models = set()
+    if not isinstance(workflow, dict):
+        return frozenset()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs", {})
+        for name in MODEL_INPUTS.get(node.get("class_type"), ()):
+            if isinstance(inputs.get(name), str):
+                models.add(inputs[name])
+    return frozenset(models)
+
+
+class PendingJob:
+    def __init__(self, job, models):
+        self.job = job
+        self.models = models
+        self.enqueued = time.monotonic()
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is offered to a queue that is already at its maximum depth
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """
+    Holds admitted jobs and runs them with bounded concurrency.
+
+    Args:
+    - run_job (coroutine function): Called with the job dict to execute it
+    - max_size (int): Maximum number of jobs waiting to start
+    - concurrency (int): Number of jobs executing at the same time
+    - avg_job_seconds (float): Initial estimate of a job's duration
+    - affinity_max_wait (float): Seconds the oldest job may be passed over for jobs
+      using the loaded models, 0 keeps strict FIFO order
+    """
+
+    def __init__(self, run_job, max_size=32, concurrency=2, avg_job_seconds=30, affinity_max_wait=60):
+        self.run_job = run_job
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.avg_job_seconds = avg_job_seconds
+        self.affinity_max_wait = affinity_max_wait
+        self.pending = deque()
+        # models of the last job started, the ones ComfyUI most likely holds
+        self.resident = frozenset()
+        self.running = 0
+        self.ready = asyncio.Semaphore(0)
+        self.workers = []
+
+    def depth(self):
+        return len(self.pending)
+
+    def retry_after(self):
+        """
+        Seconds until a slot is expected to free up, based on the current depth
+        """
+        waiting = len(self.pending) + self.running
+        return max(1, math.ceil(waiting / self.concurrency * self.avg_job_seconds))
+
+    def put(self, job, workflow=None):
+        """
+        Adds a job, workflow is the one it will run when the job input doesn't carry it (templates)
+        """
+        if len(self.pending) >= self.max_size:
+            raise QueueFull(self.retry_after())
+        if workflow is None:
+            workflow = job.get("input", {}).get("workflow")
+        self.pending.append(PendingJob(job, workflow_models(workflow)))
+        self.ready.release()
+        return len(self.pending)
+
+    def take(self):
+        """
+        Removes the next job to run: the oldest one, unless a younger job needs fewer
+        model loads and the oldest hasn't waited longer than affinity_max_wait
+        """
+        head = self.pending[0]
+        chosen = 0
+        if (
+            self.affinity_max_wait > 0
+            and self.resident
+            and time.monotonic() - head.enqueued < self.affinity_max_wait
+        ):
+            fewest = len(head.models - self.resident)
+            for index, entry in enumerate(self.pending):
+                if fewest == 0:
+                    break
+                missing = len(entry.models - self.resident)
+                if missing < fewest:
+                    fewest, chosen = missing, index
+
+        entry = self.pending[chosen]
+        del self.pending[chosen]
+        loads = len(entry.models - self.resident)
+        if chosen:
+            # only a deviation from FIFO saves anything, the oldest job still loads its models later
+            fifo_loads = len(head.models - self.resident)
+            QUEUE_REORDERS.inc()
+            REORDER_LOADS_SAVED.inc(amount=fifo_loads - loads)
+        MODEL_LOADS.inc(amount=loads)
+        if entry.models:
+            self.resident = entry.models
+        return entry.job
+
+    async def worker(self):
+        while True:
+            await self.ready.acquire()
+            job = self.take()
+            self.running += 1
+            started = time.monotonic()
+            try:
+                await self.run_job(job)
+            except Exception as e:
+                utils.log(f"Job {job.get('id')} failed: {e}")
+            finally:
+                self.running -= 1
+                duration = time.monotonic() - started
+                self.avg_job_seconds += DURATION_SMOOTHING * (duration - self.avg_job_seconds)
+
+    async def start(self, app=None):
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, app=None):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "running": self.running,
+            "max_size": self.max_size,
+            "concurrency": self.concurrency,
+        }
@@ -1,19 +1,37 @@
 import os
 import json
-import handler
+import startup
 
 port = int(os.environ.get("PORT", 3000))
 cloud_type = os.environ.get("CLOUD_TYPE")
 env = os.environ.get("ENV", "production")
+max_queue_size = int(os.environ.get("MAX_QUEUE_SIZE", 32))
+max_concurrent_jobs = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))
+affinity_max_wait = float(os.environ.get("JOB_AFFINITY_MAX_WAIT", 60))
 
 
 def run():
+    # imported here, not at module level: the encoder's worker processes import this
+    # module again as __mp_main__ and must not open the status store, write the
+    # credential files or record startup phases a second time.
+    # Marked before the heavy imports, so their time shows up in the timeline
+    startup.mark("handler_start")
+
+    import handler
+    import metrics
+    import model_cache
+    import templates
+    import utils
+    import warmup
+    import webhooks
+    import workflow_schema
+
     if cloud_type == "GCP" or cloud_type == "AWS":
         import uuid
         import asyncio
-        import gpustat
-        import psutil
+        import resources
         from aiohttp import web
+        from job_queue import JobQueue, QueueFull
 
         if env == "development":
             test_json_path = "/app/test_input.json"
@@ -24,56 +42,173 @@ def run():
                 job = {"id": run_id, "input": test_data["input"]}
                 print(f"Running test with JSON file: {test_json_path}")
                 handler.handler(job)
+                webhooks.flush(timeout=30)
                 print(f"Test completed with successfully")
             else:
                 print(f"Test JSON file not found: {test_json_path}")
 
             return
 
-        async def run_handler(run_id, data):
-            await asyncio.to_thread(handler.handler, {"id": run_id, "input": data["input"]})
+        async def run_handler(job):
+            await asyncio.to_thread(handler.handler, job)
+
+        job_queue = JobQueue(
+            run_handler, max_queue_size, max_concurrent_jobs, affinity_max_wait=affinity_max_wait
+        )
 
         async def handle_post(request):
             try:
-                data = await request.json()  # Read JSON data from the request
+                try:
+                    data = await request.json()  # Read JSON data from the request
+                except json.JSONDecodeError:
+                    return web.json_response({"error": "Request body must be valid JSON"}, status=400)
                 run_id = str(uuid.uuid4())  # Generate a unique job ID
 
+                job_input = data.get("input") if isinstance(data, dict) else None
+                if not isinstance(job_input, dict):
+                    return web.json_response(
+                        {"error": "Request body must be a JSON object with an 'input' object"}, status=400
+                    )
+
+                # broken workflows never take a queue slot, only checked once the schema is loaded.
+                # Unknown models pass, the handler refetches the schema in case they are new
+                try:
+                    if job_input.get("template_id") is not None:
+                        # bound here for the checks and the queue's model affinity
+                        workflow = templates.resolve(job_input)
+                    else:
+                        workflow = utils.validate_json(job_input.get("workflow"))
+                except templates.TemplateError as e:
+                    return web.json_response({"error": f"Invalid template: {e}"}, status=400)
+                errors = workflow_schema.validate(workflow, fetch=False) if workflow is not None else []
+                if errors:
+                    return web.json_response(
+                        {"error": "Invalid workflow", "validation_errors": errors}, status=400
+                    )
+
+                # Queue the job, workers pick it up in the background
+                try:
+                    job_queue.put({"id": run_id, "input": job_input}, workflow)
+                except QueueFull as e:
+                    return web.json_response(
+                        {"error": "Queue is full", "retry_after": e.retry_after},
+                        status=429,
+                        headers={"Retry-After": str(e.retry_after)},
+                    )
+
+                handler.callback_data[run_id] = {
+                    "run_id": run_id,
+                    "status": "queued",
+                    "data": {"progress": 0},
+                }
+
                 # Send response back immediately
                 response_data = {"message": "Job created!", "run_id": run_id}
-                response = web.json_response(response_data)
-
-                # Schedule the rp_handler to run in the background
-                asyncio.create_task(run_handler(run_id, data))
-
-                return response
+                return web.json_response(response_data)
             except Exception as e:
                 return web.json_response({"error": str(e)}, status=500)
 
         def status(request):
             run_id = request.match_info["run_id"]  # Extract path parameter
-            return web.json_response(handler.callback_data[run_id])
+            data = handler.get_status(run_id)
+            if data is None:
+                return web.json_response({"error": "Job not found"}, status=404)
+            return web.json_response(data)
+
+        sampler = resources.get_sampler()
 
         def health(request):
-            gpu_stats = gpustat.new_query()
+            # answered from the background sampler, never measures in the request
+            sample = sampler.latest() or {}
+            gpus = sample.get("gpus") or []
             response_data = {
                 "status": "ok",
-                "gpu": gpu_stats.gpus[0].utilization,
-                "cpu": psutil.cpu_percent(interval=1),
+                "gpu": gpus[0]["utilization"] if gpus else None,
+                "cpu": (sample.get("host") or {}).get("cpu_percent"),
+                "sampled_at": sample.get("time"),
+                "queue": job_queue.stats(),
+                "warmup": warmup.report()["status"],
+                "model_cache": model_cache.stats(),
             }
             response = web.json_response(response_data)
             return response
 
+        def health_history(request):
+            since = request.query.get("since")
+            try:
+                since = float(since) if since is not None else None
+            except ValueError:
+                return web.json_response({"error": "'since' must be a unix timestamp"}, status=400)
+            return web.json_response(
+                {"interval": sampler.interval, "samples": sampler.history(since)}
+            )
+
+        async def start_sampler(app):
+            sampler.start()
+
+        async def stop_sampler(app):
+            await asyncio.to_thread(sampler.stop)
+
+        def ready(request):
+            # only route traffic here once the models are loaded
+            return web.json_response(warmup.report(), status=200 if warmup.is_ready() else 503)
+
+        def startup_report(request):
+            return web.json_response(startup.report())
+
+        async def start_warmup(app):
+            startup.mark("handler_ready")
+            warmup.start()
+
+        def list_templates(request):
+            return web.json_response({"templates": templates.list_templates()})
+
+        def get_template(request):
+            try:
+                return web.json_response(templates.describe(request.match_info["template_id"]))
+            except templates.TemplateError as e:
+                return web.json_response({"error": str(e)}, status=404)
+
+        async def register_template(request):
+            try:
+                data = await request.json()
+                template = templates.register(
+                    request.match_info["template_id"], data.get("workflow"), data.get("parameters")
+                )
+            except (ValueError, AttributeError, templates.TemplateError) as e:
+                return web.json_response({"error": str(e)}, status=400)
+            return web.json_response(template.describe())
+
+        def metrics_handler(request):
+            return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
         # Create the aiohttp web app
         app = web.Application()
+        app.on_startup.append(job_queue.start)
+        app.on_startup.append(start_warmup)
+        app.on_startup.append(start_sampler)
+        app.on_cleanup.append(job_queue.stop)
+        app.on_cleanup.append(stop_sampler)
         app.add_routes([web.get("/health", health)])  # Route for GET requests
+        app.add_routes([web.get("/health/history", health_history)])  # Sampled resource usage
         app.add_routes([web.post("/run", handle_post)])  # Route for POST requests
         app.add_routes([web.get("/status/{run_id}", status)])  # Route for POST requests
+        app.add_routes([web.get("/templates", list_templates)])  # Registered workflow templates
+        app.add_routes([web.get("/templates/{template_id}", get_template)])
+        app.add_routes([web.put("/templates/{template_id}", register_template)])  # Register/replace a template
+        app.add_routes([web.get("/metrics", metrics_handler)])  # Prometheus scrape endpoint
+        app.add_routes([web.get("/ready", ready)])  # Readiness, 503 until warmed up
+        app.add_routes([web.get("/startup", startup_report)])  # Cold start timeline
 
         web.run_app(app, port=port)
 
     elif cloud_type == "RUNPOD":
         import runpod
 
+        # don't pick up jobs before the models are loaded
+        startup.mark("handler_ready")
+        warmup.run()
+        utils.log({"startup": startup.report()})
         runpod.serverless.start({"handler": handler.handler})
     else:
         raise ValueError(f"Invalid cloud type: {cloud_type}")
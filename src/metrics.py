@@ -0,0 +1,205 @@
+"""
+Minimal Prometheus style metrics for the worker, served as text from /metrics,
+plus the per-node execution timeline recorded for every job.
+"""
+
+import threading
+import time
+
+# upper bounds in seconds, from cheap utility nodes up to long sampling runs
+NODE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+JOB_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+
+REGISTRY = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                yield self.name, format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, optionally split by labels
+    """
+
+    kind = "gauge"
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, optionally split by labels
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=NODE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def samples(self):
+        with self.lock:
+            for label_values, (counts, count, total) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                    yield f"{self.name}_bucket", labels, bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + ("+Inf",))
+                yield f"{self.name}_bucket", labels, count
+                labels = format_labels(self.labels, label_values)
+                yield f"{self.name}_count", labels, count
+                yield f"{self.name}_sum", labels, total
+
+
+def render():
+    """
+    Returns all registered metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+NODE_SECONDS = Histogram(
+    "comfy_node_seconds", "Wall time spent executing a node", ("class_type",), NODE_BUCKETS
+)
+NODE_CACHE_HITS = Counter(
+    "comfy_node_cache_hits_total", "Nodes skipped because ComfyUI had them cached", ("class_type",)
+)
+JOB_SECONDS = Histogram(
+    "comfy_job_execution_seconds", "Wall time between execution start and end of a job", (), JOB_BUCKETS
+)
+JOBS = Counter("comfy_jobs_total", "Jobs finished, by status", ("status",))
+
+
+class NodeTimeline:
+    """
+    Records when each node of a workflow started and finished executing,
+    based on the websocket events ComfyUI sends for the prompt.
+
+    Args:
+    - workflow (dict): The workflow being executed, used to resolve class types
+    """
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.current = None
+        self.current_started = None
+        self.nodes = []
+
+    def class_type(self, node_id):
+        return self.workflow.get(node_id, {}).get("class_type", "unknown")
+
+    def close_current(self, now):
+        if self.current is None:
+            return
+        self.nodes.append(
+            {
+                "node": self.current,
+                "class_type": self.class_type(self.current),
+                "seconds": round(now - self.current_started, 4),
+                "cached": False,
+            }
+        )
+        self.current = None
+
+    def update(self, event):
+        now = time.monotonic()
+        event_type = event.get("type")
+        data = event.get("data") or {}
+
+        if event_type == "execution_start":
+            self.started = now
+        elif event_type == "execution_cached":
+            for node_id in data.get("nodes", []):
+                self.nodes.append(
+                    {"node": node_id, "class_type": self.class_type(node_id), "seconds": 0, "cached": True}
+                )
+        elif event_type == "executing":
+            self.close_current(now)
+            if data.get("node") is None:
+                self.finished = now
+            else:
+                self.current = data["node"]
+                self.current_started = now
+        elif event_type in ("execution_success", "execution_error", "execution_interrupted"):
+            self.close_current(now)
+            self.finished = now
+
+    def summary(self):
+        started = self.started if self.started is not None else self.created
+        return {
+            "wait_seconds": round(started - self.created, 4),
+            "execution_seconds": round((self.finished or time.monotonic()) - started, 4),
+            "nodes": self.nodes,
+        }
+
+    def observe(self, status):
+        """
+        Adds this job's timeline to the worker wide histograms
+        """
+        JOBS.inc(status)
+        for node in self.nodes:
+            if node["cached"]:
+                NODE_CACHE_HITS.inc(node["class_type"])
+            else:
+                NODE_SECONDS.observe(node["seconds"], node["class_type"])
+        if self.started is not None and self.finished is not None:
+            JOB_SECONDS.observe(self.finished - self.started)
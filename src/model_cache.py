@@ -0,0 +1,343 @@
+"""
+Local disk tier in front of the NFS models share.
+
+Model files are copied from the share to MODEL_CACHE_PATH, either at startup for
+the presets being warmed up or in the background the first time a job uses them.
+start.sh lists the cache directory first in extra_model_paths.yaml, so ComfyUI
+loads the local copy once it exists and falls back to the share until then.
+The cache is size bounded (least recently used models are removed first) and
+copies are checked against the share's size/mtime and the optional sha256 of
+the preset's model files.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import utils
+from job_queue import MODEL_INPUTS
+
+# empty disables the local tier
+MODEL_CACHE_PATH = os.environ.get("MODEL_CACHE_PATH", "")
+MODEL_CACHE_MAX_BYTES = int(os.environ.get("MODEL_CACHE_MAX_BYTES", 200 * 1024**3))
+MODEL_CACHE_WORKERS = int(os.environ.get("MODEL_CACHE_WORKERS", 2))
+MODELS_SHARE_PATH = os.environ.get("FS_PATH", "") + os.environ.get("MODELS_PATH", "/models")
+
+INDEX_FILE = "index.json"
+# ComfyUI only lists known model extensions, so half copied files stay invisible
+PARTIAL_SUFFIX = ".partial"
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# loader node class -> models folders the file may be in
+LOADER_FOLDERS = {
+    "UNETLoader": ("diffusion_models", "unet"),
+    "UnetLoaderGGUF": ("diffusion_models", "unet"),
+    "CheckpointLoaderSimple": ("checkpoints",),
+    "CLIPLoader": ("clip", "text_encoders"),
+    "CLIPLoaderGGUF": ("clip", "text_encoders"),
+    "DualCLIPLoader": ("clip", "text_encoders"),
+    "DualCLIPLoaderGGUF": ("clip", "text_encoders"),
+    "VAELoader": ("vae",),
+    "LoraLoader": ("loras",),
+    "LoraLoaderModelOnly": ("loras",),
+    "UpscaleModelLoader": ("upscale_models",),
+}
+
+HITS = metrics.Counter("comfy_model_cache_hits_total", "Model loads served from the local disk tier")
+MISSES = metrics.Counter("comfy_model_cache_misses_total", "Model loads that had to read the NFS share")
+BYTES_SAVED = metrics.Counter("comfy_model_cache_bytes_saved_total", "Model bytes not read from the NFS share")
+BYTES_COPIED = metrics.Counter("comfy_model_cache_bytes_copied_total", "Model bytes copied to the local disk tier")
+USED_BYTES = metrics.Gauge("comfy_model_cache_used_bytes", "Size of the local disk tier")
+
+
+def workflow_model_paths(workflow):
+    """
+    Returns the (folders, file name) pairs of the models a workflow loads
+    """
+    paths = set()
+    for node in workflow.values():
+        class_type = node.get("class_type")
+        folders = LOADER_FOLDERS.get(class_type)
+        if folders is None:
+            continue
+        for name in MODEL_INPUTS.get(class_type, ()):
+            value = node.get("inputs", {}).get(name)
+            if isinstance(value, str):
+                paths.add((folders, value))
+    return paths
+
+
+class Entry:
+    def __init__(self, size, source_mtime, used=None):
+        self.size = size
+        self.source_mtime = source_mtime
+        self.used = used or time.time()
+
+
+class ModelCache:
+    """
+    Size bounded LRU copy of model files from the share on local disk.
+
+    Args:
+    - path (str): Local directory, laid out like the models share
+    - share_path (str): Root of the NFS models share
+    - max_bytes (int): Total size above which least recently used models are removed
+    """
+
+    def __init__(self, path=MODEL_CACHE_PATH, share_path=MODELS_SHARE_PATH, max_bytes=MODEL_CACHE_MAX_BYTES):
+        self.path = path
+        self.share_path = share_path
+        self.max_bytes = max_bytes
+        # relative path ("vae/ae.safetensors") -> Entry, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # bytes of copies in progress, counted against max_bytes until they finish
+        self.reserved = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=MODEL_CACHE_WORKERS, thread_name_prefix="model-cache")
+        os.makedirs(path, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        """
+        Picks up copies from a previous run, dropping anything that doesn't match its index entry
+        """
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        for relative_path, entry in sorted(index.items(), key=lambda item: item[1].get("used", 0)):
+            local_path = os.path.join(self.path, relative_path)
+            if os.path.exists(local_path) and os.path.getsize(local_path) == entry.get("size"):
+                self.entries[relative_path] = Entry(entry["size"], entry.get("source_mtime"), entry.get("used"))
+                self.size += entry["size"]
+            elif os.path.exists(local_path):
+                os.remove(local_path)
+
+        # copies interrupted by a restart
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if file.endswith(PARTIAL_SUFFIX):
+                    os.remove(os.path.join(root, file))
+        USED_BYTES.set(value=self.size)
+
+    def save_index(self):
+        index = {
+            relative_path: {"size": entry.size, "source_mtime": entry.source_mtime, "used": entry.used}
+            for relative_path, entry in self.entries.items()
+        }
+        tmp_path = os.path.join(self.path, INDEX_FILE + PARTIAL_SUFFIX)
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def find_source(self, folders, name):
+        for folder in folders:
+            source = os.path.join(self.share_path, folder, name)
+            if os.path.isfile(source):
+                return os.path.join(folder, name), source
+        return None, None
+
+    def is_fresh(self, relative_path, source):
+        """
+        True if the local copy exists and the share's file didn't change since it was copied
+        """
+        entry = self.entries.get(relative_path)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(source)
+            local_size = os.path.getsize(os.path.join(self.path, relative_path))
+        except OSError:
+            return False
+        return stat.st_size == entry.size == local_size and stat.st_mtime == entry.source_mtime
+
+    def use(self, workflow):
+        """
+        Counts the models of a job as hits or misses and copies the missing ones in the background
+        """
+        for folders, name in workflow_model_paths(workflow):
+            relative_path, source = self.find_source(folders, name)
+            if source is None:
+                # baked into the image or unknown, nothing to cache
+                continue
+            with self.lock:
+                fresh = self.is_fresh(relative_path, source)
+                if fresh:
+                    entry = self.entries[relative_path]
+                    entry.used = time.time()
+                    self.entries.move_to_end(relative_path)
+            if fresh:
+                HITS.inc()
+                BYTES_SAVED.inc(amount=entry.size)
+            else:
+                MISSES.inc()
+                self.submit(relative_path, source)
+
+    def prefill(self, model_files):
+        """
+        Copies the model files of a preset before they are used, waits for the copies
+
+        Args:
+        - model_files (list): Entries of a custom/model_files json, {"url", "path", "hash"?}
+        """
+        futures = []
+        for item in model_files:
+            parts = item.get("path", "").split("/models/", 1)
+            if len(parts) != 2:
+                continue
+            source = os.path.join(self.share_path, parts[1])
+            if os.path.isfile(source):
+                futures.append(self.submit(parts[1], source, item.get("hash")))
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                utils.log(f"Model cache prefill failed: {e}")
+
+    def submit(self, relative_path, source, hash=None):
+        with self.lock:
+            future = self.inflight.get(relative_path)
+            if future is None:
+                future = self.inflight[relative_path] = self.pool.submit(self.copy, relative_path, source, hash)
+            return future
+
+    def copy(self, relative_path, source, hash=None):
+        tmp_path = None
+        reserved = 0
+        try:
+            with self.lock:
+                if self.is_fresh(relative_path, source):
+                    return
+            stat = os.stat(source)
+            if stat.st_size > self.max_bytes:
+                utils.log(f"Model cache: {relative_path} is larger than the whole cache, not copying")
+                return
+            with self.lock:
+                self.remove(relative_path)
+                self.evict(stat.st_size)
+                if self.size + self.reserved + stat.st_size > self.max_bytes:
+                    utils.log(f"Model cache: no room for {relative_path} next to the copies in progress, not copying")
+                    return
+                self.reserved += stat.st_size
+                reserved = stat.st_size
+
+            local_path = os.path.join(self.path, relative_path)
+            tmp_path = local_path + PARTIAL_SUFFIX
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            started = time.monotonic()
+            digest = hashlib.sha256() if hash else None
+            with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+                for block in iter(lambda: src.read(COPY_BUFFER_SIZE), b""):
+                    dst.write(block)
+                    if digest is not None:
+                        digest.update(block)
+
+            # the share's file may have been replaced while copying
+            if os.path.getsize(tmp_path) != stat.st_size or os.stat(source).st_mtime != stat.st_mtime:
+                raise OSError(f"{source} changed while copying")
+            if digest is not None and digest.hexdigest() != hash.lower():
+                raise OSError(f"sha256 mismatch for {source}")
+            os.replace(tmp_path, local_path)
+            tmp_path = None
+
+            with self.lock:
+                self.entries[relative_path] = Entry(stat.st_size, stat.st_mtime)
+                self.size += stat.st_size
+                self.reserved -= reserved
+                reserved = 0
+                self.save_index()
+                USED_BYTES.set(value=self.size)
+            BYTES_COPIED.inc(amount=stat.st_size)
+            seconds = time.monotonic() - started
+            utils.log(f"Model cache: copied {relative_path} ({stat.st_size} bytes) in {seconds:.1f}s")
+        except Exception as e:
+            utils.log(f"Model cache: unable to copy {relative_path}: {e}")
+            # a partial copy left behind would take disk space the index doesn't know of
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            with self.lock:
+                self.reserved -= reserved
+                self.inflight.pop(relative_path, None)
+
+    def remove(self, relative_path):
+        entry = self.entries.pop(relative_path, None)
+        if entry is not None:
+            self.size -= entry.size
+        local_path = os.path.join(self.path, relative_path)
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+    def evict(self, incoming):
+        """
+        Removes least recently used models until incoming bytes fit next to the copies in progress
+        """
+        evicted = False
+        for relative_path in list(self.entries):
+            if self.size + self.reserved + incoming <= self.max_bytes:
+                break
+            utils.log(f"Model cache: evicting {relative_path}")
+            self.remove(relative_path)
+            evicted = True
+        if evicted:
+            self.save_index()
+            USED_BYTES.set(value=self.size)
+
+    def stats(self):
+        hits = sum(HITS.values.values())
+        misses = sum(MISSES.values.values())
+        return {
+            "entries": len(self.entries),
+            "used_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+            "bytes_saved": sum(BYTES_SAVED.values.values()),
+        }
+
+
+cache = None
+cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the worker wide ModelCache, or None when the local tier is disabled or unusable
+    """
+    global cache
+    with cache_lock:
+        if cache is None and MODEL_CACHE_PATH:
+            try:
+                cache = ModelCache()
+            except OSError as e:
+                utils.log(f"Model cache disabled, unable to use {MODEL_CACHE_PATH}: {e}")
+                cache = False
+        return cache or None
+
+
+def use(workflow):
+    model_cache = get_cache()
+    if model_cache is not None:
+        model_cache.use(workflow)
+
+
+def prefill(model_files):
+    model_cache = get_cache()
+    if model_cache is not None:
+        model_cache.prefill(model_files)
+
+
+def stats():
+    model_cache = get_cache()
+    return model_cache.stats() if model_cache is not None else None
@@ -0,0 +1,164 @@
+"""
+Background sampling of the worker's resource usage.
+
+A thread collects CPU, RAM, GPU utilization/VRAM and ComfyUI's /system_stats
+every RESOURCE_SAMPLE_INTERVAL seconds into a ring buffer. /health answers from
+the latest sample instead of measuring inside the request, and the buffer is
+served as a time series for capacity planning.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import comftroller
+import metrics
+
+RESOURCE_SAMPLE_INTERVAL = float(os.environ.get("RESOURCE_SAMPLE_INTERVAL", 5))
+# samples kept, one hour at the default interval
+RESOURCE_HISTORY_SIZE = int(os.environ.get("RESOURCE_HISTORY_SIZE", 720))
+
+SYSTEM_STATS_TIMEOUT = 2
+
+CPU_PERCENT = metrics.Gauge("comfy_cpu_percent", "CPU utilization of the worker")
+RAM_USED = metrics.Gauge("comfy_ram_used_bytes", "RAM in use on the worker")
+GPU_UTILIZATION = metrics.Gauge("comfy_gpu_utilization_percent", "GPU utilization", ("gpu",))
+GPU_MEMORY_USED = metrics.Gauge("comfy_gpu_memory_used_bytes", "GPU memory in use", ("gpu",))
+
+
+def sample_host():
+    try:
+        import psutil
+    except ImportError:
+        return {}
+    memory = psutil.virtual_memory()
+    return {
+        # percentage since the previous call, never blocks
+        "cpu_percent": psutil.cpu_percent(interval=None),
+        "ram_used": memory.used,
+        "ram_total": memory.total,
+        "ram_percent": memory.percent,
+    }
+
+
+def sample_gpus():
+    try:
+        import gpustat
+    except ImportError:
+        return []
+    return [
+        {
+            "index": gpu.index,
+            "name": gpu.name,
+            "utilization": gpu.utilization,
+            # gpustat reports MiB
+            "memory_used": gpu.memory_used * 1024 * 1024,
+            "memory_total": gpu.memory_total * 1024 * 1024,
+            "temperature": gpu.temperature,
+        }
+        for gpu in gpustat.new_query().gpus
+    ]
+
+
+def sample_comfy():
+    response = comftroller.session.get(f"{comftroller.API_URL}/system_stats", timeout=SYSTEM_STATS_TIMEOUT)
+    response.raise_for_status()
+    stats = response.json()
+    return {
+        "ram_free": stats.get("system", {}).get("ram_free"),
+        "devices": [
+            {
+                "name": device.get("name"),
+                "vram_total": device.get("vram_total"),
+                "vram_free": device.get("vram_free"),
+                "torch_vram_total": device.get("torch_vram_total"),
+                "torch_vram_free": device.get("torch_vram_free"),
+            }
+            for device in stats.get("devices", [])
+        ],
+    }
+
+
+class ResourceSampler:
+    """
+    Samples resource usage on a background thread into a ring buffer.
+
+    Args:
+    - interval (float): Seconds between two samples
+    - size (int): Number of samples kept
+    """
+
+    def __init__(self, interval=RESOURCE_SAMPLE_INTERVAL, size=RESOURCE_HISTORY_SIZE):
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopped.clear()
+                self.thread = threading.Thread(target=self.run, name="resource-sampler", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join(timeout=self.interval + SYSTEM_STATS_TIMEOUT)
+
+    def run(self):
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            sample = self.sample()
+            with self.lock:
+                self.samples.append(sample)
+            self.stopped.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def sample(self):
+        sample = {"time": time.time()}
+        for key, collect in (("host", sample_host), ("gpus", sample_gpus), ("comfy", sample_comfy)):
+            try:
+                sample[key] = collect()
+            except Exception as e:
+                # one source failing (ComfyUI still booting, no driver) shouldn't drop the others
+                sample[key] = None
+                sample.setdefault("errors", {})[key] = str(e)
+
+        host = sample.get("host") or {}
+        if "cpu_percent" in host:
+            CPU_PERCENT.set(value=host["cpu_percent"])
+            RAM_USED.set(value=host["ram_used"])
+        for gpu in sample.get("gpus") or []:
+            GPU_UTILIZATION.set(str(gpu["index"]), value=gpu["utilization"])
+            GPU_MEMORY_USED.set(str(gpu["index"]), value=gpu["memory_used"])
+        return sample
+
+    def latest(self):
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def history(self, since=None):
+        """
+        Returns the buffered samples, oldest first, optionally only those taken after since (unix time)
+        """
+        with self.lock:
+            samples = list(self.samples)
+        if since is not None:
+            samples = [sample for sample in samples if sample["time"] > since]
+        return samples
+
+
+sampler = None
+sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    global sampler
+    with sampler_lock:
+        if sampler is None:
+            sampler = ResourceSampler()
+        return sampler
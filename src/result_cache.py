@@ -0,0 +1,203 @@
+"""
+Result cache for deterministic workflows.
+
+A job is keyed by a canonical hash of its workflow, the content of its input
+files and its upload target. Uploaded outputs of completed jobs are kept in a
+bounded index with a TTL and handed back to identical jobs, and an identical
+job submitted while the first one still runs waits for it instead of running
+the same sampling pass twice.
+"""
+
+import base64
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import image_cache
+import metrics
+
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 1000))
+# 0 disables the cache and the deduplication of running jobs
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 3600))
+
+# inputs holding the seed of a sampler or noise generator
+SEED_INPUTS = ("seed", "noise_seed")
+
+# node classes with "random" in their name that are deterministic given their inputs
+DETERMINISTIC_RANDOM_NODES = ("RandomNoise",)
+
+RESULT_CACHE = metrics.Counter(
+    "comfy_result_cache_total", "Jobs looked up in the result cache, by outcome", ("outcome",)
+)
+
+
+def canonical_json(data):
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def is_link(value):
+    # [source node id, output index]
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def is_deterministic(workflow):
+    """
+    Returns False when running the workflow twice may not give the same outputs:
+    a random seed (-1, "random", ...), a node generating random values or a
+    remote image the prefetch couldn't pin to its content.
+    """
+    for node in workflow.values():
+        class_type = node.get("class_type", "")
+        if "random" in class_type.lower() and class_type not in DETERMINISTIC_RANDOM_NODES:
+            return False
+        inputs = node.get("inputs", {})
+        for name, value in inputs.items():
+            if name in SEED_INPUTS or name.endswith("_seed"):
+                if is_link(value):
+                    continue
+                if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                    return False
+        url_input = image_cache.URL_INPUTS.get(class_type)
+        url = inputs.get(url_input) if url_input else None
+        if isinstance(url, str) and url.startswith(("http://", "https://")):
+            return False
+    return True
+
+
+def job_key(workflow, files=(), upload=None):
+    """
+    Returns the cache key of a job, or None if its outputs can't be reused
+
+    Args:
+    - workflow (dict): The workflow as it will be queued (after prefetching remote images)
+    - files (list): Base64 encoded input files
+    - upload (dict): The upload target and options, outputs are only reused for the same target
+    """
+    if RESULT_CACHE_TTL <= 0 or not is_deterministic(workflow):
+        return None
+
+    # titles and other UI metadata don't change what a node computes
+    nodes = {
+        node_id: {k: v for k, v in node.items() if k != "_meta"}
+        for node_id, node in workflow.items()
+    }
+    digest = hashlib.sha256()
+    digest.update(canonical_json(nodes).encode("utf-8"))
+    for file in files or []:
+        digest.update(hashlib.sha256(base64.b64decode(file)).digest())
+    digest.update(canonical_json(upload or {}).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Flight:
+    """
+    A job running for a key, identical jobs wait on it
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.outputs = None
+
+
+class ResultCache:
+    """
+    TTL'd LRU of job outputs by job key, plus the jobs currently running per key.
+
+    Args:
+    - max_entries (int): Maximum number of results kept
+    - ttl (int): Seconds a result is reused after the job completed
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, ttl=RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored, outputs = entry
+        if time.time() - stored > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return outputs
+
+    def acquire(self, key, timeout=None):
+        """
+        Returns the outputs of an identical job, waiting for it if it's running.
+        Returns None when the caller has to run the job itself, it must then call release.
+
+        Args:
+        - key (str): The job key
+        - timeout (float): Seconds to wait for a running identical job before running
+          this one anyway, its release then hands the outputs to the other waiters too
+        """
+        joined = False
+        while True:
+            with self.lock:
+                outputs = self.lookup(key)
+                if outputs is not None:
+                    RESULT_CACHE.inc("joined" if joined else "hit")
+                    return copy.deepcopy(outputs)
+                flight = self.inflight.get(key)
+                if flight is None:
+                    self.inflight[key] = Flight()
+                    RESULT_CACHE.inc("miss")
+                    return None
+
+            if not flight.done.wait(timeout):
+                RESULT_CACHE.inc("timeout")
+                return None
+            joined = True
+            if flight.outputs is not None:
+                RESULT_CACHE.inc("joined")
+                return copy.deepcopy(flight.outputs)
+            # the job failed, one of the waiting jobs takes over
+
+    def release(self, key, outputs=None, store=True):
+        """
+        Ends the job running for key
+
+        Args:
+        - key (str): The key acquire returned None for
+        - outputs (list): Outputs of the job, None if it failed
+        - store (bool): Keep the outputs for later jobs, only worth it when they are uploaded
+        """
+        with self.lock:
+            flight = self.inflight.pop(key, None)
+            if outputs is not None and store:
+                self.entries[key] = (time.time(), outputs)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        if flight is not None:
+            flight.outputs = outputs
+            flight.done.set()
+
+
+cache = None
+cache_lock = threading.Lock()
+
+
+def get_cache():
+    global cache
+    with cache_lock:
+        if cache is None:
+            cache = ResultCache()
+        return cache
+
+
+def acquire(key, timeout=None):
+    return get_cache().acquire(key, timeout)
+
+
+def release(key, outputs=None, store=True):
+    get_cache().release(key, outputs, store)
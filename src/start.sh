@@ -1,8 +1,18 @@
 #!/usr/bin/env bash
 set -eo pipefail
 
+# cold start timeline, the handler appends its own phases to the same file
+export STARTUP_TIMELINE_PATH=${STARTUP_TIMELINE_PATH:-/tmp/startup_timeline}
+export COMFY_LOG_PATH=${COMFY_LOG_PATH:-/tmp/comfyui.log}
+: > $STARTUP_TIMELINE_PATH
+mark() {
+  echo "$1 $(date +%s.%N)" >> $STARTUP_TIMELINE_PATH
+}
+mark container_start
+
 # mount file store if fs ip is set
 if [ -n "$FS_SHARE" ]; then
+  mark nfs_mount_start
   echo "Mounting Cloud Filestore."
   mkdir -p $FS_PATH$DATA_PATH
   mkdir -p $FS_PATH$MODELS_PATH
@@ -17,16 +27,43 @@ if [ -n "$FS_SHARE" ]; then
       mount -t nfs -o nolock $FS_SHARE$MODELS_PATH $FS_PATH$MODELS_PATH
   fi
   echo "Mounting completed."
+  mark nfs_mount_done
 fi
 
 # Update /comfyui/extra_model_paths.yaml to set comfyui.base_path using sed, since yq is not available
-sed -i "s|^\([[:space:]]*base_path:\).*|\1 \"$FS_PATH$MODELS_PATH\"|" /comfyui/extra_model_paths.yaml
+# (first base_path only, the model_cache section below has its own)
+sed -i "0,/base_path:/s|^\([[:space:]]*base_path:\).*|\1 \"$FS_PATH$MODELS_PATH\"|" /comfyui/extra_model_paths.yaml
+
+# local disk tier for models, listed first so ComfyUI prefers the copies the handler makes
+if [ -n "$MODEL_CACHE_PATH" ] && ! grep -q "^model_cache:" /comfyui/extra_model_paths.yaml; then
+  mkdir -p $MODEL_CACHE_PATH
+  {
+    echo ""
+    echo "model_cache:"
+    echo "    base_path: \"$MODEL_CACHE_PATH\""
+    echo "    is_default: true"
+    # same folders as the share
+    grep -E "^[[:space:]]+[a-z_]+: [a-z_]+/$" /comfyui/extra_model_paths.yaml
+  } > /tmp/model_cache_paths.yaml
+  cat /tmp/model_cache_paths.yaml >> /comfyui/extra_model_paths.yaml
+fi
+
+# outputs stay on local disk when the handler collects them over the wire (view/websocket)
+if [ "${OUTPUT_MODE:-filesystem}" = "filesystem" ]; then
+  OUTPUT_DIR=$FS_PATH$DATA_PATH
+else
+  OUTPUT_DIR=${OUTPUT_PATH:-/comfyui/output}
+  mkdir -p $OUTPUT_DIR
+fi
 
 echo "worker-comfy: Starting ComfyUI"
-python3 /comfyui/main.py --listen --port $COMFY_PORT --input-directory $FS_PATH$DATA_PATH --output-directory $FS_PATH$DATA_PATH --disable-auto-launch --disable-metadata &
+mark comfyui_launch
+# the log is kept for the custom node import times in the startup report
+python3 /comfyui/main.py --listen --port $COMFY_PORT --input-directory $FS_PATH$DATA_PATH --output-directory $OUTPUT_DIR --disable-auto-launch --disable-metadata > >(tee $COMFY_LOG_PATH) 2>&1 &
 COMFY_PID=$!
 
 echo "worker-comfy: Starting Handler"
+mark handler_launch
 python3 -u /app/main.py
 HANDLER_EXIT_CODE=$?
 
@@ -0,0 +1,119 @@
+"""
+Cold start timeline of the worker.
+
+start.sh and the handler append "<phase> <unix time>" lines to a shared timeline
+file as the container boots (NFS mount, ComfyUI launch, handler start, ComfyUI
+reachable, warmup, first job). The report combines it with the per custom node
+import times ComfyUI prints to its log.
+"""
+
+import os
+import re
+import threading
+import time
+
+import utils
+
+STARTUP_TIMELINE_PATH = os.environ.get("STARTUP_TIMELINE_PATH", "/tmp/startup_timeline")
+COMFY_LOG_PATH = os.environ.get("COMFY_LOG_PATH", "/tmp/comfyui.log")
+
+# "   0.3 seconds (IMPORT FAILED): /comfyui/custom_nodes/ComfyUI-Foo"
+IMPORT_TIME_PATTERN = re.compile(r"^\s*([\d.]+) seconds( \(IMPORT FAILED\))?: (.+?)\s*$")
+# headers of the blocks the import times are printed in
+IMPORT_SECTIONS = {
+    "Prestartup times for custom nodes:": "prestartup",
+    "Import times for custom nodes:": "import",
+}
+
+marked = set()
+marked_lock = threading.Lock()
+
+
+def mark(phase):
+    """
+    Records that the worker reached a phase, only the first time it does
+    """
+    with marked_lock:
+        if phase in marked:
+            return
+        marked.add(phase)
+        try:
+            with open(STARTUP_TIMELINE_PATH, "a") as f:
+                f.write(f"{phase} {time.time():.6f}\n")
+        except OSError as e:
+            utils.log(f"Unable to record startup phase {phase}: {e}")
+
+
+def read_timeline(path=STARTUP_TIMELINE_PATH):
+    phases = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    try:
+                        phases.append((parts[0], float(parts[1])))
+                    except ValueError:
+                        continue
+    except FileNotFoundError:
+        pass
+    return sorted(phases, key=lambda phase: phase[1])
+
+
+def read_import_times(path=COMFY_LOG_PATH):
+    """
+    Returns the custom node import times ComfyUI logged, slowest first
+    """
+    nodes = []
+    section = None
+    try:
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                header = line.strip()
+                if header in IMPORT_SECTIONS:
+                    section = IMPORT_SECTIONS[header]
+                    continue
+                match = IMPORT_TIME_PATTERN.match(line) if section else None
+                if match is None:
+                    section = None
+                    continue
+                path_name = match.group(3)
+                nodes.append(
+                    {
+                        "name": os.path.basename(path_name.rstrip("/")),
+                        "path": path_name,
+                        "stage": section,
+                        "seconds": float(match.group(1)),
+                        "failed": match.group(2) is not None,
+                    }
+                )
+    except FileNotFoundError:
+        pass
+    return sorted(nodes, key=lambda node: node["seconds"], reverse=True)
+
+
+def report():
+    """
+    Returns the startup timeline, every phase with its offset from the first one
+    and the time until the next, plus the custom node import times
+    """
+    timeline = read_timeline()
+    phases = []
+    for index, (phase, at) in enumerate(timeline):
+        next_at = timeline[index + 1][1] if index + 1 < len(timeline) else None
+        phases.append(
+            {
+                "phase": phase,
+                "at": at,
+                "offset_seconds": round(at - timeline[0][1], 3),
+                "seconds": round(next_at - at, 3) if next_at is not None else None,
+            }
+        )
+    custom_nodes = read_import_times()
+    return {
+        "total_seconds": round(timeline[-1][1] - timeline[0][1], 3) if timeline else None,
+        "phases": phases,
+        "custom_nodes": custom_nodes,
+        "custom_nodes_seconds": round(sum(node["seconds"] for node in custom_nodes), 3),
+        "failed_custom_nodes": [node["name"] for node in custom_nodes if node["failed"]],
+    }
@@ -0,0 +1,155 @@
+"""
+Bounded storage for job statuses served by /status/{run_id}.
+Entries expire after a TTL and the least recently updated ones are evicted first.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import utils
+
+STATUS_STORE_MAX_ENTRIES = int(os.environ.get("STATUS_STORE_MAX_ENTRIES", 1000))
+STATUS_STORE_TTL = int(os.environ.get("STATUS_STORE_TTL", 3600))
+STATUS_STORE_PATH = os.environ.get("STATUS_STORE_PATH")
+
+# only finished jobs are written to disk, in-flight progress stays in memory
+PERSISTED_STATUSES = ("completed", "failed")
+
+# how many disk writes happen between two sweeps of expired rows
+SWEEP_EVERY_WRITES = 100
+
+
+class MemoryStatusStore:
+    """
+    In-memory LRU of job statuses with TTL expiry. Supports the dict operations
+    the handler uses (get, [], []=, in).
+
+    Args:
+    - max_entries (int): Maximum number of statuses kept
+    - ttl (int): Seconds a status is kept after its last update
+    """
+
+    def __init__(self, max_entries=STATUS_STORE_MAX_ENTRIES, ttl=STATUS_STORE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def set(self, run_id, data):
+        with self.lock:
+            self.entries[run_id] = (time.time(), data)
+            self.entries.move_to_end(run_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, run_id, default=None):
+        with self.lock:
+            entry = self.entries.get(run_id)
+            if entry is None:
+                return default
+            updated, data = entry
+            if time.time() - updated > self.ttl:
+                del self.entries[run_id]
+                return default
+            return data
+
+    def __setitem__(self, run_id, data):
+        self.set(run_id, data)
+
+    def __getitem__(self, run_id):
+        data = self.get(run_id)
+        if data is None:
+            raise KeyError(run_id)
+        return data
+
+    def __contains__(self, run_id):
+        return self.get(run_id) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteStatusStore(MemoryStatusStore):
+    """
+    MemoryStatusStore backed by a SQLite (WAL) file, so finished jobs
+    can still be looked up after a restart.
+
+    Args:
+    - path (str): Location of the database file
+    """
+
+    def __init__(self, path, max_entries=STATUS_STORE_MAX_ENTRIES, ttl=STATUS_STORE_TTL):
+        super().__init__(max_entries, ttl)
+        self.db_lock = threading.Lock()
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS status (run_id TEXT PRIMARY KEY, updated REAL, data TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS status_updated ON status (updated)")
+        self.sweep()
+
+    def set(self, run_id, data):
+        super().set(run_id, data)
+        if data.get("status") not in PERSISTED_STATUSES:
+            return
+        try:
+            with self.db_lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO status (run_id, updated, data) VALUES (?, ?, ?)",
+                    (run_id, time.time(), json.dumps(data)),
+                )
+                self.writes += 1
+                if self.writes % SWEEP_EVERY_WRITES == 0:
+                    self.sweep_locked()
+        except sqlite3.Error as e:
+            utils.log(f"Error persisting status for {run_id}: {e}")
+
+    def get(self, run_id, default=None):
+        data = super().get(run_id)
+        if data is not None:
+            return data
+        try:
+            with self.db_lock:
+                row = self.db.execute(
+                    "SELECT updated, data FROM status WHERE run_id = ?", (run_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            utils.log(f"Error reading status for {run_id}: {e}")
+            return default
+        if row is None or time.time() - row[0] > self.ttl:
+            return default
+        data = json.loads(row[1])
+        # keep it warm in memory for the next poll
+        super().set(run_id, data)
+        return data
+
+    def sweep(self):
+        with self.db_lock:
+            self.sweep_locked()
+
+    def sweep_locked(self):
+        self.db.execute("DELETE FROM status WHERE updated < ?", (time.time() - self.ttl,))
+        self.db.execute(
+            "DELETE FROM status WHERE run_id NOT IN "
+            "(SELECT run_id FROM status ORDER BY updated DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+
+def create_store(path=STATUS_STORE_PATH):
+    """
+    Returns a SQLite backed store when a path is configured, otherwise an in-memory one
+    """
+    if path:
+        try:
+            return SQLiteStatusStore(path)
+        except sqlite3.Error as e:
+            utils.log(f"Unable to open status store at {path}, using memory: {e}")
+    return MemoryStatusStore()
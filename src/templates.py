@@ -0,0 +1,258 @@
+"""
+Server-side workflow templates.
+
+A template is a workflow registered once under an id, either from a file in
+WORKFLOW_TEMPLATES_PATH ({id}.json, the examples/ are baked in) or through the
+API. Jobs then send only the template_id and a small map of parameters instead
+of the whole graph. Templates are compiled when registered: _meta is dropped
+and every parameter is resolved to the node inputs it sets, so binding a job
+only copies the nodes it changes and shares the others with the template.
+Nothing downstream modifies a workflow in place, so the sharing is safe.
+
+A parameter is either declared by the template ("prompt": ["6.text", "7.text"])
+or addresses a node input directly ("25.noise_seed"). Either way the input has
+to exist on the template's node.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+import utils
+
+WORKFLOW_TEMPLATES_PATH = os.environ.get("WORKFLOW_TEMPLATES_PATH", "/app/templates")
+
+TEMPLATE_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,127}$")
+
+
+class TemplateError(Exception):
+    pass
+
+
+def content_hash(workflow, parameters=None):
+    """
+    Returns the sha256 of a template's workflow and parameters, to tell a changed template from a resent one
+    """
+    content = json.dumps(
+        {"workflow": workflow, "parameters": parameters or {}}, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def parse_target(target):
+    """
+    Returns the (node id, input name) a "node_id.input_name" target points at
+    """
+    if isinstance(target, str) and "." in target:
+        node_id, input_name = target.split(".", 1)
+        return node_id, input_name
+    raise TemplateError(f"invalid parameter target {target!r}, expected 'node_id.input_name'")
+
+
+class Template:
+    """
+    A compiled workflow template.
+
+    Args:
+    - template_id (str): Name jobs refer to the template by
+    - workflow (dict): Workflow in API format
+    - parameters (dict): Parameter name -> "node_id.input_name" or a list of them
+    """
+
+    def __init__(self, template_id, workflow, parameters=None):
+        if not isinstance(workflow, dict) or not workflow:
+            raise TemplateError(f"template {template_id} has no workflow")
+        if not all(isinstance(node, dict) for node in workflow.values()):
+            raise TemplateError(f"template {template_id} has nodes that aren't objects")
+        self.id = template_id
+        self.hash = content_hash(workflow, parameters)
+        self.workflow = {
+            str(node_id): {key: value for key, value in node.items() if key != "_meta"}
+            for node_id, node in workflow.items()
+        }
+        if parameters is not None and not isinstance(parameters, dict):
+            raise TemplateError(f"parameters of template {template_id} must be an object")
+        self.parameters = {}
+        for name, targets in (parameters or {}).items():
+            targets = targets if isinstance(targets, list) else [targets]
+            self.parameters[name] = [self.check_target(parse_target(target)) for target in targets]
+
+    def check_target(self, target):
+        node_id, input_name = target
+        if node_id not in self.workflow:
+            raise TemplateError(f"template {self.id} has no node {node_id}")
+        # a typo would otherwise add an input ComfyUI ignores and run with the template's value
+        if input_name not in self.workflow[node_id].get("inputs", {}):
+            raise TemplateError(f"node {node_id} of template {self.id} has no input '{input_name}'")
+        return node_id, input_name
+
+    def bind(self, values):
+        """
+        Returns the workflow with the parameters applied, only the changed nodes are copies
+
+        Args:
+        - values (dict): Parameter name or "node_id.input_name" -> value
+        """
+        if values is not None and not isinstance(values, dict):
+            raise TemplateError("'parameters' must be an object")
+        changes = {}
+        for name, value in (values or {}).items():
+            targets = self.parameters.get(name)
+            if targets is None:
+                if "." not in name:
+                    raise TemplateError(f"template {self.id} has no parameter '{name}'")
+                targets = [self.check_target(parse_target(name))]
+            for node_id, input_name in targets:
+                changes.setdefault(node_id, {})[input_name] = value
+
+        workflow = dict(self.workflow)
+        for node_id, inputs in changes.items():
+            node = dict(workflow[node_id])
+            node["inputs"] = {**node.get("inputs", {}), **inputs}
+            workflow[node_id] = node
+        return workflow
+
+    def describe(self):
+        return {
+            "template_id": self.id,
+            "hash": self.hash,
+            "nodes": len(self.workflow),
+            "parameters": {
+                name: [f"{node_id}.{input_name}" for node_id, input_name in targets]
+                for name, targets in self.parameters.items()
+            },
+        }
+
+
+def read_template_file(path):
+    """
+    Returns the (workflow, parameters) of a template file: {"workflow", "parameters"?}
+    or a job input like the examples/ ({"input": {"workflow", "template_parameters"?}})
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    if isinstance(data.get("input"), dict):
+        data = data["input"]
+    workflow = utils.validate_json(data.get("workflow"))
+    return workflow, data.get("parameters") or data.get("template_parameters")
+
+
+class TemplateRegistry:
+    """
+    Templates by id, loaded from a directory on first use.
+
+    Args:
+    - path (str): Directory with {id}.json template files, API registrations are written there too
+    """
+
+    def __init__(self, path=WORKFLOW_TEMPLATES_PATH):
+        self.path = path
+        self.templates = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not os.path.isdir(self.path):
+                return
+            for file in sorted(os.listdir(self.path)):
+                if not file.endswith(".json"):
+                    continue
+                template_id = file[: -len(".json")]
+                try:
+                    workflow, parameters = read_template_file(os.path.join(self.path, file))
+                    self.templates[template_id] = Template(template_id, workflow, parameters)
+                except (OSError, ValueError, AttributeError, TemplateError) as e:
+                    utils.log(f"Skipping workflow template {file}: {e}")
+            utils.log(f"Loaded {len(self.templates)} workflow template(s) from {self.path}")
+
+    def get(self, template_id):
+        self.load()
+        template = self.templates.get(template_id)
+        if template is None:
+            raise TemplateError(f"unknown template_id '{template_id}'")
+        return template
+
+    def register(self, template_id, workflow, parameters=None, persist=True):
+        """
+        Compiles and stores a template, replacing one with the same id.
+        Resending the content the id already has keeps the compiled template and the file.
+
+        Returns:
+        Template: The compiled template
+        """
+        if not isinstance(template_id, str) or not TEMPLATE_ID_PATTERN.match(template_id):
+            raise TemplateError(f"invalid template_id {template_id!r}")
+        workflow = utils.validate_json(workflow)
+        self.load()
+        with self.lock:
+            current = self.templates.get(template_id)
+            if current is not None and current.hash == content_hash(workflow, parameters):
+                return current
+        template = Template(template_id, workflow, parameters)
+        # written under the lock, so the file ends up with the same version as the registry
+        with self.lock:
+            self.templates[template_id] = template
+            if persist:
+                try:
+                    os.makedirs(self.path, exist_ok=True)
+                    tmp_path = os.path.join(self.path, f".{template_id}.json.tmp")
+                    with open(tmp_path, "w") as f:
+                        json.dump({"workflow": workflow, "parameters": parameters or {}}, f)
+                    os.replace(tmp_path, os.path.join(self.path, f"{template_id}.json"))
+                except OSError as e:
+                    # still usable until the worker restarts
+                    utils.log(f"Unable to store workflow template {template_id}: {e}")
+        utils.log(f"Registered workflow template {template_id} ({template.hash[:12]})")
+        return template
+
+    def list(self):
+        self.load()
+        with self.lock:
+            return [template.describe() for template in self.templates.values()]
+
+
+registry = None
+registry_lock = threading.Lock()
+
+
+def get_registry():
+    global registry
+    with registry_lock:
+        if registry is None:
+            registry = TemplateRegistry()
+        return registry
+
+
+def bind(template_id, parameters=None):
+    return get_registry().get(template_id).bind(parameters)
+
+
+def register(template_id, workflow, parameters=None):
+    return get_registry().register(template_id, workflow, parameters)
+
+
+def resolve(job_input):
+    """
+    Returns the workflow of a job that names a template_id. A job that also sends a
+    workflow registers it under that id first (with "template_parameters"), then
+    "parameters" are applied. Both /run and the handler resolve the job, only the
+    first one that sees new content registers it.
+    """
+    template_id = job_input["template_id"]
+    if job_input.get("workflow") is not None:
+        register(template_id, job_input["workflow"], job_input.get("template_parameters"))
+    return bind(template_id, job_input.get("parameters"))
+
+
+def describe(template_id):
+    return get_registry().get(template_id).describe()
+
+
+def list_templates():
+    return get_registry().list()
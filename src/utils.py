@@ -4,8 +4,26 @@ This module contains utility functions for file handling.
 
 # required imports for utility functions:
 import base64
+import hashlib
 import json
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# number of files uploaded (and converted) at the same time, shared by all jobs
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+
+# objects larger than this are uploaded in parts (S3 multipart / GCS resumable), 8MB
+UPLOAD_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# number of distinct storage clients (credentials/endpoints) kept warm
+STORAGE_CLIENT_CACHE_SIZE = int(os.environ.get("STORAGE_CLIENT_CACHE_SIZE", 8))
+
+upload_pool = None
+upload_pool_lock = threading.Lock()
+storage_clients = OrderedDict()
+storage_clients_lock = threading.Lock()
 
 
 def log(string):
@@ -118,97 +136,214 @@ def setup_storage_credentials():
         log("No storage credentials set")
 
 
-def upload_file(file, bucket, key, cloud_type="GCP", credentials=None):
+upload_credentials = {}
+
+
+def get_upload_credentials():
+    """
+    Returns the decoded UPLOAD_CREDENTIALS, or None when not set
+    """
+    encoded = os.getenv("UPLOAD_CREDENTIALS")
+    if not encoded:
+        return None
+    if encoded not in upload_credentials:
+        upload_credentials.clear()
+        upload_credentials[encoded] = json.loads(base64.b64decode(encoded).decode("utf-8"))
+    return upload_credentials[encoded]
+
+
+def create_storage_client(cloud_type, credentials=None):
+    if cloud_type == "AWS":
+        import boto3
+        from botocore.config import Config
+
+        # enough pooled connections for every concurrent upload (and multipart part)
+        config = Config(max_pool_connections=max(10, UPLOAD_WORKERS * 4))
+        # clients may be built from several upload threads at once, boto3's default session isn't thread safe
+        session = boto3.session.Session()
+
+        if credentials:
+            # Check if custom endpoint URL is provided (for S3-compatible services)
+            if credentials.get("aws_url"):
+                return session.client(
+                    "s3",
+                    aws_access_key_id=credentials.get("aws_access_key_id"),
+                    aws_secret_access_key=credentials.get("aws_secret_access_key"),
+                    endpoint_url=credentials.get("aws_url"),
+                    region_name="auto",
+                    config=config,
+                )
+            return session.client(
+                "s3",
+                aws_access_key_id=credentials.get("aws_access_key_id"),
+                aws_secret_access_key=credentials.get("aws_secret_access_key"),
+                region_name=credentials.get("region_name", "us-east-1"),
+                config=config,
+            )
+        # Use default credentials from environment/IAM role
+        return session.client("s3", config=config)
+
+    else:  # Default to GCP
+        from google.cloud import storage
+
+        if credentials:
+            return storage.Client.from_service_account_json(credentials)
+        return storage.Client()
+
+
+def get_storage_client(cloud_type, credentials=None):
+    """
+    Returns a storage client for the given cloud and credentials, reusing an
+    existing one (and its connection pool) when the same credentials were seen before.
+    Clients are shared across jobs and threads, the least recently used is evicted.
+
+    Args:
+    - cloud_type (str): Either "GCP" or "AWS"
+    - credentials (dict|str): Optional credentials for the cloud provider
+    """
+    fingerprint = hashlib.sha256(
+        json.dumps(credentials, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    endpoint = credentials.get("aws_url") if isinstance(credentials, dict) else None
+    cache_key = (cloud_type, fingerprint, endpoint)
+
+    with storage_clients_lock:
+        client = storage_clients.get(cache_key)
+        if client is not None:
+            storage_clients.move_to_end(cache_key)
+            return client
+
+    # built outside the lock, credential resolution can take a while
+    client = create_storage_client(cloud_type, credentials)
+
+    with storage_clients_lock:
+        client = storage_clients.setdefault(cache_key, client)
+        storage_clients.move_to_end(cache_key)
+        while len(storage_clients) > STORAGE_CLIENT_CACHE_SIZE:
+            storage_clients.popitem(last=False)
+    return client
+
+
+def upload_file(file, bucket, key, cloud_type="GCP", credentials=None, options=None):
     """
     Uploads a file to a cloud storage bucket (GCP or AWS).
-    Converts PNG files to JPEG before uploading.
+    Images are (re-)encoded on the encoder process pool when a format is requested,
+    by default PNG files are converted to JPEG unless the key ends with .png.
+    An image extension on the key is changed to the one of the encoded format.
+    Encoding happens in memory, the source file is removed once every upload succeeded.
 
     Args:
-    - file (dict): Dictionary with 'name' and 'path' keys for the file to upload.
+    - file (dict): Dictionary with 'name' and either 'path' or in-memory 'data' bytes.
     - bucket (str): The name of the bucket to upload to.
     - key (str): The key/path to upload the file to.
     - cloud_type (str): Either "GCP" for Google Cloud Storage or "AWS" for S3.
     - credentials (dict): Optional credentials for cloud provider.
+    - options (dict): Optional 'format' (jpeg/webp/png), 'quality' and 'renditions'
+      (list of maximum edge sizes for extra downscaled copies).
     """
+    import io
+    import mimetypes
+    import encoder
 
     file_name = file["name"]
-    file_path = file["path"]
-
-    if credentials is None and os.getenv("UPLOAD_CREDENTIALS"):
-        credentials = json.loads(
-            base64.b64decode(os.getenv("UPLOAD_CREDENTIALS")).decode("utf-8")
+    file_path = file.get("path")
+    file_data = file.get("data")
+    options = options or {}
+
+    if credentials is None:
+        credentials = get_upload_credentials()
+
+    format = encoder.normalize_format(options.get("format"))
+    quality = int(options.get("quality") or encoder.DEFAULT_QUALITY)
+    renditions = [int(size) for size in options.get("renditions") or []]
+    source_ext = file_name.rsplit(".", 1)[-1].lower()
+
+    if source_ext not in encoder.ENCODABLE_EXTENSIONS:
+        # videos/gifs etc. are uploaded untouched
+        source_format = format = None
+        renditions = []
+    else:
+        source_format = encoder.normalize_format(source_ext)
+        if format is None and source_format == "png" and not key.endswith(".png"):
+            format = "jpeg"
+
+    target_format = format or source_format
+    passthrough = format is None or format == source_format
+
+    encoded = []
+    if renditions or not passthrough:
+        log(f"Encoding {file_name} as {target_format}")
+        encoded = encoder.encode(
+            file_path if file_data is None else file_data, target_format, quality, renditions, not passthrough
         )
 
-    # Convert PNG to JPEG if necessary
-    if file_name.endswith(".png") and not key.endswith(".png"):
-        from PIL import Image
-
-        Image.MAX_IMAGE_PIXELS = 300000000
-
-        log(f"Converting PNG to JPEG: {file_name}")
-
-        # Open the PNG image
-        img = Image.open(file_path)
-
-        # Convert RGBA to RGB if necessary (JPEG doesn't support transparency)
-        if img.mode in ("RGBA", "LA", "P"):
-            # Create a white background
-            background = Image.new("RGB", img.size, (255, 255, 255))
-            if img.mode == "P":
-                img = img.convert("RGBA")
-            background.paste(
-                img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None
-            )
-            img = background
-        elif img.mode != "RGB":
-            img = img.convert("RGB")
+    if passthrough:
+        source = file_path if file_data is None else io.BytesIO(file_data)
+        content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    else:
+        source = io.BytesIO(encoded.pop(0)[1])
+        content_type = encoder.content_type(target_format)
+        file_name = file_name.rsplit(".", 1)[0] + "." + encoder.extension(target_format)
+        # an image extension on the key follows the encoding, like the rendition keys do
+        base, _, key_ext = key.rpartition(".")
+        if base and "/" not in key_ext and key_ext.lower() in encoder.ENCODABLE_EXTENSIONS:
+            if encoder.normalize_format(key_ext) != target_format:
+                key = f"{base}.{encoder.extension(target_format)}"
+
+    result = upload_to_bucket(source, bucket, key, content_type, cloud_type, credentials)
+
+    uploaded_renditions = []
+    for size, data in encoded:
+        rendition_key = f"{key.rsplit('.', 1)[0]}_{size}.{encoder.extension(target_format)}"
+        rendition = upload_to_bucket(
+            io.BytesIO(data), bucket, rendition_key, encoder.content_type(target_format), cloud_type, credentials
+        )
+        uploaded_renditions.append({"size": size, "url": rendition["url"]})
 
-        # Create new file path with .jpg extension
-        jpeg_path = file_path.rsplit(".", 1)[0] + ".jpg"
+    # only once everything is uploaded, a failed upload keeps the only copy of the output
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
 
-        # Save as JPEG with high quality
-        img.save(jpeg_path, "JPEG", quality=95)
+    uploaded = {
+        "name": file_name,
+        "path": os.path.join(os.path.dirname(file_path), file_name) if file_path else None,
+        "url": result["url"],
+    }
+    if uploaded_renditions:
+        uploaded["renditions"] = uploaded_renditions
+    return uploaded
 
-        # Remove the original PNG file
-        os.remove(file_path)
 
-        # Update file path and name
-        file_path = jpeg_path
-        file_name = file_name.rsplit(".", 1)[0] + ".jpg"
+def upload_to_bucket(source, bucket, key, content_type, cloud_type="GCP", credentials=None):
+    """
+    Streams a file path or in-memory buffer to a cloud storage bucket (GCP or AWS).
+    Large objects go up as S3 multipart / GCS resumable uploads, both verified with checksums.
 
-        log(f"Converted to JPEG: {file_name}")
+    Returns:
+    dict: with the public 'url' of the uploaded object
+    """
 
     if cloud_type == "AWS":
-        import boto3
+        from boto3.s3.transfer import TransferConfig
 
-        # Initialize S3 client
         aws_url = credentials.get("aws_url") if credentials else None
         aws_public_url = credentials.get("aws_public_url") if credentials else None
 
-        if credentials:
-            # Check if custom endpoint URL is provided (for S3-compatible services)
-            if aws_url:
-                s3_client = boto3.client(
-                    "s3",
-                    aws_access_key_id=credentials.get("aws_access_key_id"),
-                    aws_secret_access_key=credentials.get("aws_secret_access_key"),
-                    endpoint_url=aws_url,
-                    region_name="auto",
-                )
-            else:
-                s3_client = boto3.client(
-                    "s3",
-                    aws_access_key_id=credentials.get("aws_access_key_id"),
-                    aws_secret_access_key=credentials.get("aws_secret_access_key"),
-                    region_name=credentials.get("region_name", "us-east-1"),
-                )
-        else:
-            # Use default credentials from environment/IAM role
-            s3_client = boto3.client("s3")
+        s3_client = get_storage_client(cloud_type, credentials)
+
+        # objects above the threshold are sent as multipart uploads, parts in parallel
+        transfer = TransferConfig(
+            multipart_threshold=UPLOAD_MULTIPART_THRESHOLD,
+            multipart_chunksize=UPLOAD_MULTIPART_THRESHOLD,
+        )
+        extra_args = {"ContentType": content_type, "ChecksumAlgorithm": "CRC32"}
 
         # Upload file to S3
-        s3_client.upload_file(file_path, bucket, key)
-        log(f"File {file_name} uploaded to S3 bucket {bucket} at {key}.")
+        if isinstance(source, str):
+            s3_client.upload_file(source, bucket, key, ExtraArgs=extra_args, Config=transfer)
+        else:
+            s3_client.upload_fileobj(source, bucket, key, ExtraArgs=extra_args, Config=transfer)
+        log(f"File uploaded to S3 bucket {bucket} at {key}.")
 
         # Generate the S3 URL
         if aws_public_url:
@@ -224,54 +359,100 @@ def upload_file(file, bucket, key, cloud_type="GCP", credentials=None):
             )
             url = f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
 
-        os.remove(file_path)
-
-        return {
-            "name": file_name,
-            "path": file_path,
-            "url": url,
-        }
+        return {"url": url}
 
     else:  # Default to GCP
-        from google.cloud import storage
-
-        if credentials:
-            storage_client = storage.Client.from_service_account_json(credentials)
-        else:
-            storage_client = storage.Client()
+        storage_client = get_storage_client(cloud_type, credentials)
         bucket_obj = storage_client.bucket(bucket)
 
-        blob = bucket_obj.blob(key)
-        blob.upload_from_filename(file_path)
-        log(f"File {file_name} uploaded to GCS bucket {bucket} at {key}.")
-        os.remove(file_path)
+        blob = bucket_obj.blob(key, chunk_size=UPLOAD_MULTIPART_THRESHOLD)
+        # crc32c is checked against what GCS stored. Objects of a known size up to 8MB go
+        # as a single multipart request, larger ones or ones without a size are resumable
+        if isinstance(source, str):
+            blob.upload_from_filename(source, content_type=content_type, checksum="crc32c")
+        else:
+            size = source.getbuffer().nbytes - source.tell()
+            blob.upload_from_file(source, content_type=content_type, size=size, checksum="crc32c")
+        log(f"File uploaded to GCS bucket {bucket} at {key}.")
 
         # return the url of the uploaded file
-        return {
-            "name": file_name,
-            "path": file_path,
-            "url": blob.public_url,
-        }
+        return {"url": blob.public_url}
 
 
-def upload_files(files, bucket, key, cloud_type, credentials=None):
+class UploadError(Exception):
+    """
+    Raised when one or more files of a batch failed to upload
+
+    Args:
+    - files (list): The upload results in input order, failed files carry an 'error' key
+    """
+
+    def __init__(self, files):
+        self.files = files
+        failed = [f"{file['name']}: {file['error']}" for file in files if "error" in file]
+        super().__init__(f"{len(failed)} of {len(files)} file(s) failed to upload ({'; '.join(failed)})")
+
+
+def get_upload_pool():
+    global upload_pool
+    with upload_pool_lock:
+        if upload_pool is None:
+            upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+        return upload_pool
+
+
+def upload_name(file_name, options=None):
+    """
+    Name of an output inside a multi-file upload, with the extension of the requested format
+    """
+    import encoder
+
+    file_name = file_name.replace("_00001_", "")
+    format = encoder.normalize_format((options or {}).get("format"))
+    base, _, ext = file_name.rpartition(".")
+    if format and base and ext.lower() in encoder.ENCODABLE_EXTENSIONS:
+        return f"{base}.{encoder.extension(format)}"
+    return file_name
+
+
+def upload_files(files, bucket, key, cloud_type, credentials=None, options=None):
     """
     Uploads a list of files to a cloud storage bucket (GCP or AWS).
+    Files are converted and uploaded concurrently, results keep the order of files.
+    See upload_file for the encoding options.
+
+    Raises:
+    UploadError: if any of the files failed, after all uploads have finished
     """
-    uploaded_files = []
     if len(files) == 1:
-        uploaded_files.append(
-            upload_file(files[0], bucket, key, cloud_type, credentials)
-        )
+        keys = [key]
+        # nothing to overlap, skip the hop to the pool
+        pending = [None]
     else:
         ## replace any extension from key
         key = key.split(".")[0]
-        for index, file in enumerate(files):
-            file_name = file["name"]
-            file_name = file_name.replace("_00001_", "")
-            uploaded_files.append(
-                upload_file(file, bucket, f"{key}/{file_name}", cloud_type, credentials)
-            )
+        keys = [f"{key}/{upload_name(file['name'], options)}" for file in files]
+        pool = get_upload_pool()
+        pending = [
+            pool.submit(upload_file, file, bucket, file_key, cloud_type, credentials, options)
+            for file, file_key in zip(files, keys)
+        ]
+
+    uploaded_files = []
+    failed = False
+    for file, file_key, future in zip(files, keys, pending):
+        try:
+            if future is None:
+                uploaded_files.append(upload_file(file, bucket, file_key, cloud_type, credentials, options))
+            else:
+                uploaded_files.append(future.result())
+        except Exception as e:
+            log(f"Error uploading {file['name']} to {bucket}/{file_key}: {e}")
+            uploaded_files.append({"name": file["name"], "path": file.get("path"), "error": str(e)})
+            failed = True
+
+    if failed:
+        raise UploadError(uploaded_files)
     return uploaded_files
 
 
@@ -0,0 +1,238 @@
+"""
+Model warmup before the worker takes traffic.
+
+For every preset a minimal workflow touching its diffusion model, text encoder
+and VAE is run once, so the weights are read from the models share and moved to
+the GPU before the first real job instead of during it. The workflow is taken
+from WARMUP_WORKFLOWS_PATH/{preset}.json when present, otherwise it is derived
+from the preset's custom/model_files/{preset}.json.
+"""
+
+import json
+import os
+import threading
+import time
+
+import comftroller
+import model_cache
+import startup
+import utils
+import workflow_schema
+
+# presets to warm up, defaults to the one the image was built with
+WARMUP_PRESETS = os.environ.get("WARMUP_PRESETS", os.environ.get("MODEL_FILE_NAME", ""))
+WARMUP_MODEL_FILES_PATH = os.environ.get("WARMUP_MODEL_FILES_PATH", "/comfyui/model_files")
+WARMUP_WORKFLOWS_PATH = os.environ.get("WARMUP_WORKFLOWS_PATH", "/comfyui/model_files/warmup")
+WARMUP_CLIP_TYPE = os.environ.get("WARMUP_CLIP_TYPE")
+
+# models folder -> kind of weights found in it
+MODEL_FOLDERS = {
+    "diffusion_models": "unet",
+    "unet": "unet",
+    "clip": "clip",
+    "text_encoders": "clip",
+    "vae": "vae",
+}
+
+
+def preset_names(presets=WARMUP_PRESETS):
+    names = []
+    for name in presets.split(","):
+        name = name.strip()
+        if name.endswith(".json"):
+            name = name[: -len(".json")]
+        if name:
+            names.append(name)
+    return names
+
+
+def model_name(path, folder):
+    """
+    Returns the name ComfyUI lists a model file under, relative to its models folder
+    """
+    parts = path.split("/")
+    index = len(parts) - 1 - parts[::-1].index(folder)
+    return "/".join(parts[index + 1 :])
+
+
+def derive_workflow(model_files):
+    """
+    Builds a one step, 64px workflow loading every model of a preset.
+    The latent comes from encoding an empty image, so it always has the channels the VAE expects.
+
+    Args:
+    - model_files (list): Entries of a custom/model_files json, {"url", "path"}
+
+    Returns:
+    dict: The workflow, or None if the preset has no diffusion model, text encoder and VAE
+    """
+    models = {"unet": [], "clip": [], "vae": []}
+    for item in model_files:
+        path = item.get("path", "")
+        for folder, kind in MODEL_FOLDERS.items():
+            if f"/{folder}/" in path:
+                models[kind].append(model_name(path, folder))
+                break
+    if not all(models.values()):
+        return None
+
+    unet = models["unet"][0]
+    clips = models["clip"][:2]
+    gguf = lambda name: name.endswith(".gguf")
+    clip_type = WARMUP_CLIP_TYPE or ("flux2" if any("flux2" in name for name in [unet] + clips) else "flux")
+
+    if len(clips) == 2:
+        clip_loader = {
+            "class_type": "DualCLIPLoaderGGUF" if any(map(gguf, clips)) else "DualCLIPLoader",
+            "inputs": {"clip_name1": clips[0], "clip_name2": clips[1], "type": clip_type},
+        }
+    else:
+        clip_loader = {
+            "class_type": "CLIPLoaderGGUF" if gguf(clips[0]) else "CLIPLoader",
+            "inputs": {"clip_name": clips[0], "type": clip_type},
+        }
+
+    return {
+        "1": {
+            "class_type": "UnetLoaderGGUF" if gguf(unet) else "UNETLoader",
+            "inputs": {"unet_name": unet} if gguf(unet) else {"unet_name": unet, "weight_dtype": "default"},
+        },
+        "2": clip_loader,
+        "3": {"class_type": "VAELoader", "inputs": {"vae_name": models["vae"][0]}},
+        "4": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["2", 0]}},
+        "5": {"class_type": "EmptyImage", "inputs": {"width": 64, "height": 64, "batch_size": 1, "color": 0}},
+        "6": {"class_type": "VAEEncode", "inputs": {"pixels": ["5", 0], "vae": ["3", 0]}},
+        "7": {
+            "class_type": "KSampler",
+            "inputs": {
+                "model": ["1", 0],
+                "positive": ["4", 0],
+                "negative": ["4", 0],
+                "latent_image": ["6", 0],
+                "seed": 0,
+                "steps": 1,
+                "cfg": 1.0,
+                "sampler_name": "euler",
+                "scheduler": "simple",
+                "denoise": 1.0,
+            },
+        },
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["7", 0], "vae": ["3", 0]}},
+        "9": {"class_type": "PreviewImage", "inputs": {"images": ["8", 0]}},
+    }
+
+
+def load_model_files(preset):
+    with open(os.path.join(WARMUP_MODEL_FILES_PATH, f"{preset}.json"), "r") as f:
+        return json.load(f)
+
+
+def load_workflow(preset, model_files):
+    """
+    Returns the warmup workflow of a preset, None if there is nothing to warm up
+    """
+    custom_path = os.path.join(WARMUP_WORKFLOWS_PATH, f"{preset}.json")
+    if os.path.exists(custom_path):
+        with open(custom_path, "r") as f:
+            return json.load(f)
+    return derive_workflow(model_files)
+
+
+class Warmup:
+    """
+    Waits for ComfyUI, runs the warmup workflows once and keeps their state for the readiness endpoint.
+
+    Args:
+    - presets (list): Names of the presets to warm up, in order
+    """
+
+    def __init__(self, presets):
+        self.presets = {name: {"status": "pending"} for name in presets}
+        self.status = "pending"
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and not self.done.is_set():
+                self.thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        self.status = "starting"
+        if not comftroller.wait_for_server():
+            self.status = "failed"
+            self.done.set()
+            return
+        # jobs are validated against it, load it before the first one arrives
+        workflow_schema.load()
+        self.status = "warming"
+        for preset, state in self.presets.items():
+            state["status"] = "warming"
+            started = time.monotonic()
+            try:
+                model_files = load_model_files(preset)
+                # copy to local disk first, the warmup then loads from the page cache
+                model_cache.prefill(model_files)
+                workflow = load_workflow(preset, model_files)
+                if workflow is None:
+                    state["status"] = "skipped"
+                    utils.log(f"Warmup: nothing to warm up for {preset}")
+                    continue
+                outputs = comftroller.run(workflow, [], lambda data: None)
+                if outputs.get("error"):
+                    raise RuntimeError(outputs["error"])
+                state["status"] = "ready"
+            except Exception as e:
+                # a cold worker can still serve jobs, so don't hold readiness back forever
+                state["status"] = "failed"
+                state["error"] = str(e)
+                utils.log(f"Warmup of {preset} failed: {e}")
+            finally:
+                state["seconds"] = round(time.monotonic() - started, 3)
+            utils.log(f"Warmup: {preset} {state['status']} in {state['seconds']}s")
+        self.status = "ready"
+        startup.mark("warmup_done")
+        self.done.set()
+
+    def is_ready(self):
+        return self.done.is_set() and self.status == "ready"
+
+    def report(self):
+        return {"status": self.status, "presets": self.presets}
+
+
+warmup = None
+warmup_lock = threading.Lock()
+
+
+def get_warmup():
+    global warmup
+    with warmup_lock:
+        if warmup is None:
+            warmup = Warmup(preset_names())
+        return warmup
+
+
+def start():
+    """
+    Warms up in the background, see is_ready
+    """
+    get_warmup().start()
+
+
+def run():
+    """
+    Warms up and returns once done
+    """
+    get_warmup().start()
+    get_warmup().done.wait()
+
+
+def is_ready():
+    return get_warmup().is_ready()
+
+
+def report():
+    return get_warmup().report()
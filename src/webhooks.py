@@ -0,0 +1,190 @@
+"""
+Background delivery of job status webhooks.
+
+Callbacks are queued per (url, run_id) and sent by worker threads over a pooled
+session, so a slow customer endpoint never blocks the websocket listener.
+Pending "processing" updates are coalesced to the latest one, final statuses
+("completed"/"failed") are retried with backoff and delivered in order.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils
+
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+WEBHOOK_MAX_PER_HOST = int(os.environ.get("WEBHOOK_MAX_PER_HOST", 4))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", 10))
+WEBHOOK_MAX_RETRIES = int(os.environ.get("WEBHOOK_MAX_RETRIES", 5))
+
+# first retry delay in milliseconds, doubled on every further attempt
+WEBHOOK_BACKOFF_MS = 500
+
+FINAL_STATUSES = ("completed", "failed")
+
+
+class Lane:
+    """
+    Pending webhooks of a single run for a single url
+    """
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.progress = None
+        self.finals = []
+
+    def add(self, data):
+        if data.get("status") in FINAL_STATUSES:
+            # progress sent after a final status is just noise
+            self.progress = None
+            self.finals.append(data)
+        elif not self.finals:
+            self.progress = data
+
+    def next(self):
+        if self.progress is not None:
+            data, self.progress = self.progress, None
+            return data
+        if self.finals:
+            return self.finals.pop(0)
+        return None
+
+    def empty(self):
+        return self.progress is None and not self.finals
+
+
+class WebhookDispatcher:
+    """
+    Delivers webhooks from a pool of worker threads.
+
+    Args:
+    - workers (int): Number of delivery threads
+    - max_per_host (int): Concurrent requests allowed to a single host
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, max_per_host=WEBHOOK_MAX_PER_HOST):
+        self.workers = workers
+        self.max_per_host = max_per_host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(workers, max_per_host))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Condition()
+        self.lanes = {}
+        self.ready = queue.Queue()
+        self.hosts = {}
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.worker, name=f"webhook-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def send(self, url, headers, data):
+        """
+        Queues data for delivery to url, returns immediately
+        """
+        key = (url, data.get("run_id"))
+        with self.lock:
+            lane = self.lanes.get(key)
+            if lane is None:
+                lane = self.lanes[key] = Lane(url, headers)
+                # a lane is only on the ready queue while it isn't being worked on,
+                # which keeps delivery for a run sequential
+                self.ready.put(key)
+            lane.headers = headers
+            lane.add(data)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued webhook has been delivered or dropped
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.lanes:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.hosts[host]
+
+    def worker(self):
+        while True:
+            key = self.ready.get()
+            with self.lock:
+                lane = self.lanes[key]
+                data = lane.next()
+                headers = lane.headers
+            if data is not None:
+                self.deliver(lane.url, headers, data)
+            with self.lock:
+                if lane.empty():
+                    del self.lanes[key]
+                    self.lock.notify_all()
+                else:
+                    self.ready.put(key)
+
+    def deliver(self, url, headers, data):
+        final = data.get("status") in FINAL_STATUSES
+        attempts = WEBHOOK_MAX_RETRIES if final else 1
+        body = json.dumps(data)
+        for attempt in range(attempts):
+            try:
+                with self.host_limit(url):
+                    response = self.session.post(url, headers=headers, data=body, timeout=WEBHOOK_TIMEOUT)
+                if response.status_code < 500 and response.status_code != 429:
+                    return True
+                reason = f"status {response.status_code}"
+            except requests.RequestException as e:
+                reason = str(e)
+
+            if attempt + 1 < attempts:
+                time.sleep(WEBHOOK_BACKOFF_MS * 2**attempt / 1000)
+
+        utils.log(f"Webhook to {url} for {data.get('run_id')} dropped after {attempts} attempt(s): {reason}")
+        return False
+
+
+dispatcher = None
+dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """
+    Returns the worker wide WebhookDispatcher, starting it on first use
+    """
+    global dispatcher
+    with dispatcher_lock:
+        if dispatcher is None:
+            dispatcher = WebhookDispatcher()
+        dispatcher.start()
+        return dispatcher
+
+
+def send(url, headers, data):
+    get_dispatcher().send(url, headers, data)
+
+
+def flush(timeout=None):
+    if dispatcher is None:
+        return True
+    return dispatcher.flush(timeout)
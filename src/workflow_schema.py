@@ -0,0 +1,230 @@
+"""
+Validation of workflows against ComfyUI's node schema before they are queued.
+
+ComfyUI's /object_info is fetched once and kept in memory. Every workflow is
+checked locally for unknown node types, missing required inputs, links to
+missing nodes or outputs, link type mismatches and values that aren't among a
+choice input's options (sampler names, model files, ...), so a broken job is
+rejected without uploading its inputs or waiting for a GPU slot. Model files
+added to the share after the fetch are picked up by refetching the schema when
+a choice value is unknown, at most every WORKFLOW_SCHEMA_REFRESH_INTERVAL seconds.
+"""
+
+import os
+import threading
+import time
+
+import comftroller
+import metrics
+import utils
+
+WORKFLOW_VALIDATION = os.environ.get("WORKFLOW_VALIDATION", "true").lower() in ("true", "1", "yes")
+WORKFLOW_SCHEMA_REFRESH_INTERVAL = float(os.environ.get("WORKFLOW_SCHEMA_REFRESH_INTERVAL", 30))
+
+SCHEMA_FETCH_TIMEOUT = 10
+# errors reported back to the caller, the rest are only counted
+MAX_ERRORS = 20
+
+VALIDATIONS = metrics.Counter(
+    "comfy_workflow_validations_total", "Workflows checked against the node schema", ("outcome",)
+)
+
+
+def input_options(spec):
+    """
+    Returns the allowed values of a choice input, None for any other input
+
+    Args:
+    - spec (list): Input spec from /object_info, [type, options?]
+    """
+    if not isinstance(spec, (list, tuple)) or not spec:
+        return None
+    if isinstance(spec[0], list):
+        return spec[0]
+    # newer nodes declare choices as ["COMBO", {"options": [...]}]
+    if spec[0] == "COMBO" and len(spec) > 1 and isinstance(spec[1], dict):
+        return spec[1].get("options")
+    return None
+
+
+def is_upload(spec):
+    """
+    True for inputs (LoadImage's image, ...) whose value may be a file uploaded with the job
+    """
+    options = spec[1] if isinstance(spec, (list, tuple)) and len(spec) > 1 and isinstance(spec[1], dict) else {}
+    return any(key.endswith("_upload") and value for key, value in options.items())
+
+
+def types_match(output_type, input_type):
+    if not isinstance(output_type, str) or not isinstance(input_type, str):
+        # choice outputs/inputs carry their option lists as type
+        return True
+    if "*" in (output_type, input_type) or output_type == input_type:
+        return True
+    return bool(set(output_type.split(",")) & set(input_type.split(",")))
+
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def check(workflow, schema):
+    """
+    Returns the problems found in a workflow, empty if it looks runnable
+
+    Args:
+    - workflow (dict): Workflow in API format
+    - schema (dict): ComfyUI's /object_info
+
+    Returns:
+    tuple: (list of error messages, number of them about unknown choice values)
+    """
+    errors = []
+    unknown_options = 0
+    has_output = False
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or "class_type" not in node:
+            errors.append(f"node {node_id}: missing class_type")
+            continue
+        class_type = node["class_type"]
+        info = schema.get(class_type)
+        if info is None:
+            errors.append(f"node {node_id}: unknown node type {class_type}")
+            continue
+        has_output = has_output or bool(info.get("output_node"))
+        inputs = node.get("inputs", {})
+        if not isinstance(inputs, dict):
+            errors.append(f"node {node_id} ({class_type}): inputs must be an object")
+            continue
+        declared = info.get("input", {})
+        specs = {**declared.get("optional", {}), **declared.get("required", {})}
+
+        for name in declared.get("required", {}):
+            if name not in inputs:
+                errors.append(f"node {node_id} ({class_type}): required input '{name}' is missing")
+
+        for name, value in inputs.items():
+            spec = specs.get(name)
+            if spec is None:
+                # hidden and extra inputs are ignored by ComfyUI
+                continue
+            if is_link(value):
+                source_id = str(value[0])
+                source = workflow.get(source_id)
+                source_info = schema.get(source.get("class_type")) if isinstance(source, dict) else None
+                if source is None:
+                    errors.append(f"node {node_id} ({class_type}): input '{name}' links to missing node {source_id}")
+                elif source_info is not None:
+                    outputs = source_info.get("output", [])
+                    if not 0 <= value[1] < len(outputs):
+                        errors.append(
+                            f"node {node_id} ({class_type}): input '{name}' links to output {value[1]} "
+                            f"of node {source_id}, which has {len(outputs)}"
+                        )
+                    elif not types_match(outputs[value[1]], spec[0] if spec else None):
+                        errors.append(
+                            f"node {node_id} ({class_type}): input '{name}' expects {spec[0]}, "
+                            f"node {source_id} output {value[1]} is {outputs[value[1]]}"
+                        )
+                continue
+            options = input_options(spec)
+            if options is not None and value not in options and not is_upload(spec):
+                unknown_options += 1
+                errors.append(f"node {node_id} ({class_type}): '{value}' is not a valid value for '{name}'")
+
+    if not has_output and not errors:
+        errors.append("workflow has no output node")
+    return errors, unknown_options
+
+
+class WorkflowSchema:
+    """
+    Holds ComfyUI's /object_info and validates workflows against it.
+
+    Args:
+    - refresh_interval (float): Minimum seconds between two fetches of the schema
+    """
+
+    def __init__(self, refresh_interval=WORKFLOW_SCHEMA_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.schema = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        """
+        Fetches the schema again unless that happened less than refresh_interval ago
+
+        Returns:
+        dict: The schema, None if ComfyUI couldn't be reached
+        """
+        with self.lock:
+            if self.schema is not None and time.monotonic() - self.fetched_at < self.refresh_interval:
+                return self.schema
+            try:
+                response = comftroller.session.get(f"{comftroller.API_URL}/object_info", timeout=SCHEMA_FETCH_TIMEOUT)
+                response.raise_for_status()
+                self.schema = response.json()
+                utils.log(f"Workflow schema loaded, {len(self.schema)} node types")
+            except Exception as e:
+                utils.log(f"Unable to fetch the workflow schema: {e}")
+            # failed attempts count too, jobs with an unknown model don't refetch one after another
+            self.fetched_at = time.monotonic()
+            return self.schema
+
+    def validate(self, workflow, fetch=True):
+        """
+        Returns the problems found in a workflow, empty if it is valid or can't be checked
+
+        Args:
+        - workflow (dict): Workflow in API format
+        - fetch (bool): Fetch the schema if needed, False to only use what is already loaded.
+          Without fetching, workflows whose only problems are unknown choice values pass,
+          the schema can't be refreshed to check for newly added models.
+        """
+        schema = self.schema
+        if not schema and fetch:
+            schema = self.fetch()
+        if not schema:
+            VALIDATIONS.inc("skipped")
+            return []
+
+        errors, unknown_options = check(workflow, schema)
+        if unknown_options and not fetch and unknown_options == len(errors):
+            # left to the job's own validation, which refetches the schema
+            VALIDATIONS.inc("deferred")
+            return []
+        if unknown_options and fetch and time.monotonic() - self.fetched_at >= self.refresh_interval:
+            # the model may have been added to the share since the schema was fetched
+            schema = self.fetch()
+            errors, _ = check(workflow, schema)
+        VALIDATIONS.inc("invalid" if errors else "valid")
+        if len(errors) > MAX_ERRORS:
+            errors = errors[:MAX_ERRORS] + [f"... and {len(errors) - MAX_ERRORS} more"]
+        return errors
+
+
+workflow_schema = None
+workflow_schema_lock = threading.Lock()
+
+
+def get_workflow_schema():
+    global workflow_schema
+    with workflow_schema_lock:
+        if workflow_schema is None:
+            workflow_schema = WorkflowSchema()
+        return workflow_schema
+
+
+def validate(workflow, fetch=True):
+    if not WORKFLOW_VALIDATION:
+        return []
+    return get_workflow_schema().validate(workflow, fetch)
+
+
+def load():
+    """
+    Fetches the schema ahead of the first job
+    """
+    if WORKFLOW_VALIDATION:
+        get_workflow_schema().fetch()